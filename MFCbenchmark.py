@@ -0,0 +1,333 @@
+import os
+import sys
+import time
+import json
+import socket
+import resource
+import subprocess
+import threading
+import logging
+from urllib import quote, unquote
+from argparse import ArgumentParser
+
+import MFCchecker
+from MFCchecker import Logger, MFCClient, MFCManagedClient, MFCModel, MFCModelRegistry, MFCProtocol, JsonStreamDecoder, MainApplication
+from ws4py.manager import WebSocketManager
+
+# keep the benchmarks quiet, transitions would otherwise be logged for every model
+MFCchecker.LOGGER = Logger(log_level=Logger.LOG_LEVELS.FATAL, desktop_notifications_activated=False)
+logging.getLogger("ws4py").addHandler(logging.NullHandler())
+
+class FakeMessage:
+    def __init__(self, data):
+        self.data = data
+
+def model_names(count):
+    return ["model_"+str(i) for i in xrange(count)]
+
+def reply_frame(model_name, status, request_id=20):
+    return "0000"+"10 0 4242 "+str(request_id)+" 0 "+quote(json.dumps({"nm": model_name, "vs": status}))
+
+def create_client(models):
+    client = MFCClient("ws://127.0.0.1:1/fcsl", protocols=['http-only', 'chat'])
+    client.models = models
+    client.desktop_notify_enabled = False
+    return client
+
+def timed(fct, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fct()
+        duration = time.time()-start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def report(label, duration, count):
+    print(label.ljust(40)+" %10.4f s  %12.0f /s" % (duration, count/duration if duration > 0 else 0))
+
+def bench_registry(arguments):
+    names = model_names(arguments.models)
+    frames = [FakeMessage(reply_frame(name, MFCClient.STATUS_CODES.FCVIDEO_TX_IDLE if i % 2 else MFCClient.STATUS_CODES.FCVIDEO_UNKNOWN)) for i, name in enumerate(names)]
+
+    registry = MFCModelRegistry(names)
+    client = create_client(registry)
+    def sweep():
+        for frame in frames:
+            client.received_message(frame)
+    report("sweep, registry ("+str(arguments.models)+" models)", timed(sweep, arguments.repeat), len(frames))
+
+    # the lookup as it used to be done: a linear scan over a plain list for every reply
+    model_list = [MFCModel(name) for name in names]
+    def linear_sweep():
+        for name in names:
+            next((model for model in model_list if model.name==name), None)
+    report("lookups, linear scan ("+str(arguments.models)+" models)", timed(linear_sweep, 1), len(names))
+
+def bench_snapshot(arguments):
+    # measured first in the process, the growth of the peak RSS is the size of the registry
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    registry = MFCModelRegistry(model_names(arguments.models))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-start_rss
+    print("registry, "+str(arguments.models)+" models".ljust(28)+" %10.0f bytes per model" % (rss*1024.0/arguments.models))
+
+    now = time.time()
+    for i, model in enumerate(registry):
+        model.isOnline = i % 5 == 0
+        model.isMuted = i % 7 == 0
+        model.lastChange = now-i
+    report("online and not muted ("+str(arguments.models)+" models)", timed(lambda: registry.online(include_muted=False), arguments.repeat), arguments.models)
+    report("changed since ("+str(arguments.models)+" models)", timed(lambda: registry.changedSince(now-arguments.models/10), arguments.repeat), arguments.models)
+
+# the brace scanner MFCClient used before JsonStreamDecoder, kept as reference
+def legacy_json_parts(data):
+    count=0
+    startIdx=-1
+    result=[]
+    for i, ch in enumerate(data, start=0):
+        if ch == "{":
+            if startIdx == -1:
+                startIdx=i
+            count += 1
+        elif ch == "}":
+            count -= 1
+
+        if count <= 0 and startIdx != -1:
+            result.append(data[startIdx:i+1])
+            startIdx=-1
+    return result
+
+def bench_json(arguments):
+    payload = "".join(json.dumps({"lv": 4, "nm": name, "sid": i, "uid": 1000000+i, "vs": 0,
+                                  "u": {"camserv": 1234, "chat_opt": 1, "topic": "Welcome to my room"}})
+                      for i, name in enumerate(model_names(arguments.models)))
+
+    def legacy():
+        return [json.loads(part) for part in legacy_json_parts(payload)]
+    report("json, legacy scanner ("+str(arguments.models)+" objects)", timed(legacy, arguments.repeat), arguments.models)
+
+    def streaming():
+        return JsonStreamDecoder().feed(payload)
+    report("json, stream decoder ("+str(arguments.models)+" objects)", timed(streaming, arguments.repeat), arguments.models)
+
+# not a benchmark: the objects the stream decoder returns for messages split or broken in known ways
+def check_decoder(arguments):
+    cases = [
+        ("object split over three messages", ['{"nm":"a",', '"vs":0', '}'], [[], [], [{"nm": "a", "vs": 0}]]),
+        ("nested object split after a member", ['{"nm":"a","u":{"camserv":1}', ',"vs":0}'], [[], [{"nm": "a", "u": {"camserv": 1}, "vs": 0}]]),
+        ("braces inside strings", ['{"nm":"a","u":{"topic":"} {\\"x\\": {"}', '}{"nm":"b"}'], [[], [{"nm": "a", "u": {"topic": '} {"x": {'}}, {"nm": "b"}]]),
+        ("split inside a string", ['{"nm":"a{b', '}"}'], [[], [{"nm": "a{b}"}]]),
+        ("truncated object then complete ones", ['{"nm":"a","vs":0', '{"nm":"b","vs":0}', '{"nm":"c","vs":0}'], [[], [{"nm": "b", "vs": 0}], [{"nm": "c", "vs": 0}]]),
+        ("object truncated inside a string", ['{"nm":"a', '{"nm":"b","vs":0}', '{"nm":"c"}'], [[], [{"nm": "b", "vs": 0}], [{"nm": "c"}]]),
+        ("truncated object inside a message", ['{"nm":"a"}{"nm":"b","vs":0{"nm":"c"}'], [[{"nm": "a"}, {"nm": "c"}]]),
+        ("malformed object", ['{"nm":a}{"nm":"b"}'], [[{"nm": "b"}]]),
+        ]
+    failed = 0
+    for label, messages, expected in cases:
+        decoder = JsonStreamDecoder()
+        received = [decoder.feed(message) for message in messages]
+        if received != expected:
+            failed += 1
+            print(label.ljust(40)+" FAILED: "+repr(received))
+        elif decoder._pending:
+            failed += 1
+            print(label.ljust(40)+" FAILED: still pending "+repr(decoder._pending))
+        else:
+            print(label.ljust(40)+" ok")
+    if failed:
+        sys.exit(1)
+
+def bench_frames(arguments):
+    names = model_names(arguments.models)
+    frames = [FakeMessage(reply_frame(name, MFCClient.STATUS_CODES.FCVIDEO_TX_IDLE)) for name in names]
+    client = create_client(MFCModelRegistry(names))
+    def receive():
+        for frame in frames:
+            client.received_message(frame)
+
+    for label, level in [("info", Logger.LOG_LEVELS.INFO), ("debug", Logger.LOG_LEVELS.DEBUG)]:
+        MFCchecker.LOGGER = Logger(log_level=level, desktop_notifications_activated=False)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            duration = timed(receive, arguments.repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        report("frames, log level "+label+" ("+str(arguments.models)+" frames)", duration, len(frames))
+    MFCchecker.LOGGER = Logger(log_level=Logger.LOG_LEVELS.FATAL, desktop_notifications_activated=False)
+
+# the frame parsing of received_message before MFCProtocol.decode_frame, kept as reference
+def legacy_decode(frame):
+    msgs=frame[4:].split(' ')
+    msg_type = msg_from = msg_to = msg_arg1 = msg_arg2 = msg_data = ""
+    if len(msgs) >= 5:
+        msg_type, msg_from, msg_to, msg_arg1, msg_arg2 = msgs[:5]
+    if len(msgs) > 5:
+        msg_data = unquote(' '.join(msgs[5:]))
+    return msg_type, msg_from, msg_to, msg_arg1, msg_arg2, msg_data
+
+def load_corpus(path):
+    with open(path) as corpus:
+        return [line.rstrip("\n") for line in corpus if line.strip() and not line.startswith("#")]
+
+def bench_decode(arguments):
+    corpus = load_corpus(arguments.corpus)
+    # the login would query the whole registry over a socket that is not connected
+    corpus = [frame for frame in corpus if MFCProtocol.decode_frame(frame)[0] != "1"]
+    frames = corpus*max(1, arguments.models/len(corpus))
+
+    report("decode, legacy ("+str(len(frames))+" frames)", timed(lambda: [legacy_decode(frame) for frame in frames], arguments.repeat), len(frames))
+    report("decode, header only ("+str(len(frames))+" frames)", timed(lambda: [MFCProtocol.decode_frame(frame) for frame in frames], arguments.repeat), len(frames))
+
+    # the corpus is about model_0 ... model_999, a tenth of them is watched
+    registry = MFCModelRegistry(model_names(100))
+    for i, model in enumerate(registry):
+        registry.setUid(model, 100000000+i)
+    client = create_client(registry)
+    messages = [FakeMessage(frame) for frame in frames]
+    def receive():
+        for message in messages:
+            client.received_message(message)
+    report("received_message ("+str(len(frames))+" frames)", timed(receive, arguments.repeat), len(frames))
+
+# counts the replies to the model queries of the current sweep
+class ReplyCounter(object):
+    replies = 0
+    expected = 0
+    logged_in = None
+    sweep_done = None
+
+    # with a listener the session does not query its models on its own, the first sweep is sent here
+    def sessionLoggedIn(self, ws):
+        ws._check()
+        self.logged_in.set()
+
+    def sessionClosed(self, ws):
+        pass
+
+    def received_message(self, m):
+        super(ReplyCounter, self).received_message(m)
+        if m.data[4:7] == "10 ":
+            self.replies += 1
+            if self.replies == self.expected:
+                self.sweep_done.set()
+
+class CountingClient(ReplyCounter, MFCClient):
+    pass
+
+class CountingManagedClient(ReplyCounter, MFCManagedClient):
+    pass
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_mock_server(arguments, model_count):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), "MFCmockserver.py"),
+                               "--port", str(port), "--models", str(model_count), "--latency", str(arguments.latency),
+                               "--churn", str(arguments.churn), "--seed", "1"])
+    deadline = time.time()+10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return server, port
+        except socket.error:
+            if time.time() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.1)
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime+usage.ru_stime
+
+def bench_e2e(arguments):
+    print("models".rjust(8)+"  sweep avg (s)  sweep max (s)     frames/s  cpu/sweep (s)  max rss (MB)")
+    for model_count in [int(size) for size in arguments.sizes.split(",")]:
+        server, port = start_mock_server(arguments, model_count)
+        manager = None
+        clients = []
+        try:
+            registry = MFCModelRegistry(model_names(model_count), shard_count=arguments.shards)
+            if arguments.engine == MainApplication.ENGINES.MANAGED:
+                manager = WebSocketManager()
+                manager.daemon = True
+                manager.start()
+            for shard in range(arguments.shards):
+                if manager is not None:
+                    client = CountingManagedClient("ws://127.0.0.1:"+str(port)+"/", manager, protocols=['http-only', 'chat'])
+                else:
+                    client = CountingClient("ws://127.0.0.1:"+str(port)+"/", protocols=['http-only', 'chat'])
+                client.models = registry
+                client.shard = shard
+                client.desktop_notify_enabled = False
+                client.logged_in = threading.Event()
+                client.sweep_done = threading.Event()
+                client.expected = len(registry.shard(shard))
+                client.listener = client
+                client.connect()
+                clients.append(client)
+            for client in clients:
+                # logging in also runs the first sweep, wait for it before measuring
+                client.logged_in.wait(30)
+                client.sweep_done.wait(arguments.timeout)
+
+            durations = []
+            frames = 0
+            start_cpu = cpu_time()
+            for sweep in range(arguments.sweeps):
+                for client in clients:
+                    client.replies = 0
+                    client.sweep_done.clear()
+                start = time.time()
+                for client in clients:
+                    client._check()
+                for client in clients:
+                    client.sweep_done.wait(arguments.timeout)
+                durations.append(time.time()-start)
+                frames += sum(client.replies for client in clients)
+            cpu = cpu_time()-start_cpu
+        finally:
+            for client in clients:
+                client.listener = None
+                client.close()
+            if manager is not None:
+                manager.stop()
+            server.terminate()
+            server.wait()
+
+        print(str(model_count).rjust(8)+"  %13.4f  %13.4f  %11.0f  %13.4f  %12.1f" % (
+            sum(durations)/len(durations), max(durations), frames/sum(durations), cpu/arguments.sweeps,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
+
+BENCHMARKS = {
+        "registry": bench_registry,
+        "snapshot": bench_snapshot,
+        "json": bench_json,
+        "frames": bench_frames,
+        "decode": bench_decode,
+        "decoder": check_decoder,
+        "e2e": bench_e2e
+        }
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Offline benchmarks of the MFC online checker")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--models", type=int, default=10000, help="Number of models in the watchlist")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest one is reported")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="e2e: comma separated watchlist sizes")
+    parser.add_argument("--sweeps", type=int, default=3, help="e2e: number of measured sweeps per watchlist size")
+    parser.add_argument("--shards", type=int, default=1, help="e2e: number of parallel sessions")
+    parser.add_argument("--engine", default=MainApplication.ENGINES.THREADED, choices=[MainApplication.ENGINES.THREADED, MainApplication.ENGINES.MANAGED])
+    parser.add_argument("--latency", type=float, default=0.0, help="e2e: reply latency of the mock fcserver (in seconds)")
+    parser.add_argument("--churn", type=float, default=0.05, help="e2e: probability that a model changes status when queried")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "MFCframes.txt"), help="decode: file of recorded frames, one per line")
+    parser.add_argument("--timeout", type=float, default=300, help="e2e: maximum time to wait for the replies of a sweep (in seconds)")
+    arguments = parser.parse_args()
+    BENCHMARKS[arguments.benchmark](arguments)
@@ -1,13 +1,30 @@
 from ws4py.client.threadedclient import WebSocketClient
+from ws4py.client import WebSocketBaseClient
+from ws4py.manager import WebSocketManager
+from ws4py.websocket import WebSocket
+import sys
 from sys import stdout
 import threading
 import json
+import re
 import time, datetime
-from random import randint
+import heapq
+from math import isnan, isinf
+import itertools
 from subprocess import call
 import sqlite3
-from os import path
+import csv
+from os import path, unlink, rename, stat
+from stat import S_ISSOCK
+import socket
+import signal
+from argparse import ArgumentParser
 from urllib2 import unquote
+from collections import OrderedDict, deque
+from Queue import Queue, Full, Empty
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
 
 
 def enum(**enums):
@@ -35,32 +52,66 @@ class Logger:
             LOG_LEVELS.FORCE : ""
             }
 
-    def __init__(self,log_level=LOG_LEVELS.INFO, desktop_notifications_activated=True, show_user_input_prompt=False):
+    def __init__(self,log_level=LOG_LEVELS.INFO, desktop_notifications_activated=True, show_user_input_prompt=False, notifier=None, writer=None):
         self.log_level=log_level
         self.desktop_notifications_activated=desktop_notifications_activated
         self.show_user_input_prompt=show_user_input_prompt
-
-    def printline(self,string, desktop_notify=False, log_level=LOG_LEVELS.INFO):
+        self.notifier=notifier
+        # when set, the lines are written from its thread and logging never waits on the console or the disk
+        self.writer=writer
+        # the lines logged by a thread while it captures them are also written to its stream
+        self._captured=threading.local()
+        # (second, formatted time), replaced at once so that any thread can read it
+        self._timestamp=(None, None)
+
+    # None stops capturing
+    def capture(self,stream):
+        self._captured.stream=stream
+
+    def is_enabled(self,log_level):
+        return log_level >= self.log_level
+
+    # args are only formatted into the string when the line is actually logged
+    def printline(self,string, desktop_notify=False, log_level=LOG_LEVELS.INFO, args=None, notification=None):
         if log_level < self.log_level:
             return
+        if args is not None:
+            string = string % args
+
+        now = time.time()
+        if self.writer is not None:
+            self.writer.write(now, log_level, string)
+        else:
+            if self.show_user_input_prompt:
+                print
+
+            print(self.format(now, log_level, string))
+
+            if self.show_user_input_prompt:
+                stdout.write(">> ")
+                stdout.flush()
+        stream = getattr(self._captured, "stream", None)
+        if stream is not None:
+            stream.write(self.format(now, log_level, string)+"\n")
+        if desktop_notify and self.desktop_notifications_activated:
+            if self.notifier is not None:
+                self.notifier.notify(string, notification)
+            else:
+                DesktopNotifier.send(string)
 
+    def format(self, now, log_level, string):
         log_level_label = Logger.log_level_label(log_level)
         if log_level_label != "":
             log_level_label=" - "+log_level_label
+        return "["+self.timestamp(now)+log_level_label+"] "+string
 
-        msg="["+datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')+log_level_label+"] "+string
-        if self.show_user_input_prompt:
-            print
-
-        print(msg)
-
-        if self.show_user_input_prompt:
-            stdout.write(">> ")
-            stdout.flush()
-        if desktop_notify and self.desktop_notifications_activated:
-            summary="MFC online checker"
-            body=string
-            call(["notify-send", summary, body])
+    # formatted once per second
+    def timestamp(self, now):
+        second = int(now)
+        timestamp = self._timestamp
+        if timestamp[0] != second:
+            timestamp = self._timestamp = (second, datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S'))
+        return timestamp[1]
 
     @staticmethod
     def log_level_label(level):
@@ -70,12 +121,521 @@ class Logger:
             label = ""
         return label
 
-class MFCModel:
+# writes the lines of the logger from its own thread, in batches. The logging threads only append to a deque
+# and wake the writer when it went idle, they never wait on it: beyond MAX_PENDING lines, new ones are dropped.
+# Writes to the console, with the prompt of the command line after each batch, or json lines to a file that
+# is rotated once it reaches max_bytes. The answers to the commands (FORCE) are then still shown on the console
+class LogWriter(threading.Thread):
+    MAX_PENDING=100000
+    MAX_BYTES=10*1024*1024
+    BACKUP_COUNT=5
+    IDLE_WAIT=1.0
+
+    def __init__(self, logger, file_name=None, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.stopped = False
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._file = None
+        self._size = 0
+        if file_name is not None:
+            self._open()
+
+    def write(self, now, log_level, string):
+        if len(self._records) >= LogWriter.MAX_PENDING:
+            METRICS.inc("log_lines_dropped")
+            return
+        self._records.append((now, log_level, string))
+        if not self._wakeup.isSet():
+            self._wakeup.set()
+
+    # the pending lines are written before the thread ends
+    def stop(self, timeout=5.0):
+        self.stopped = True
+        self._wakeup.set()
+        if self.isAlive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            # cleared before taking the records: a line appended meanwhile sets it again or is taken now
+            self._wakeup.clear()
+            batch = []
+            try:
+                while True:
+                    batch.append(self._records.popleft())
+            except IndexError:
+                pass
+            if batch:
+                try:
+                    self._write(batch)
+                except (IOError, OSError):
+                    METRICS.inc("log_write_errors")
+            elif self.stopped:
+                break
+            else:
+                self._wakeup.wait(LogWriter.IDLE_WAIT)
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, batch):
+        if self._file is None:
+            self._writeConsole([self.logger.format(*record) for record in batch])
+            return
+        self._writeConsole([self.logger.format(*record) for record in batch if record[1] == Logger.LOG_LEVELS.FORCE])
+        text = "".join(self._json(*record)+"\n" for record in batch)
+        self._file.write(text)
+        self._file.flush()
+        self._size += len(text)
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    def _writeConsole(self, lines):
+        if not lines:
+            return
+        text = "\n".join(lines)+"\n"
+        if self.logger.show_user_input_prompt:
+            text = "\n"+text+">> "
+        stdout.write(text)
+        stdout.flush()
+
+    def _json(self, now, log_level, string):
+        record = {"time": now, "timestamp": self.logger.timestamp(now), "level": Logger.log_level_label(log_level) or "Force", "message": string}
+        try:
+            return json.dumps(record)
+        except UnicodeDecodeError:
+            record["message"] = string.decode("utf-8", "replace")
+            return json.dumps(record)
+
+    def _open(self):
+        self._file = open(self.file_name, "a")
+        self._size = self._file.tell()
+
+    # <file> becomes <file>.1, <file>.1 becomes <file>.2 and so on, the oldest one is dropped
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count-1, 0, -1):
+            if path.exists(self.file_name+"."+str(i)):
+                rename(self.file_name+"."+str(i), self.file_name+"."+str(i+1))
+        if self.backup_count > 0:
+            rename(self.file_name, self.file_name+".1")
+        else:
+            unlink(self.file_name)
+        self._open()
+
+# distribution of durations (in seconds) over fixed buckets, like the prometheus histograms
+class Histogram:
+    BUCKETS=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        # the last bucket counts the values above the largest bound
+        self.counts = [0]*(len(Histogram.BUCKETS)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(Histogram.BUCKETS) and value > Histogram.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        rank = q*self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return Histogram.BUCKETS[i] if i < len(Histogram.BUCKETS) else self.max
+        return 0.0
+
+# counters and histograms of the checker, updated from all threads. Shown by the stats command and
+# served in the prometheus text format when a metrics port is configured
+class Metrics:
+    PREFIX="mfc_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0)+value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def summary(self):
+        with self._lock:
+            lines = ["Since "+datetime.datetime.fromtimestamp(self.started_at).strftime('%Y-%m-%d %H:%M:%S')]
+            for name in sorted(self.counters):
+                lines.append(name.ljust(28)+str(self.counters[name]))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                lines.append(name.ljust(28)+"count %d, avg %.4f, p50 <= %.3f, p99 <= %.3f, max %.4f" % (
+                    histogram.count, histogram.sum/histogram.count, histogram.quantile(0.5), histogram.quantile(0.99), histogram.max))
+            return lines
+
+    def prometheus(self):
+        with self._lock:
+            lines = []
+            for name in sorted(self.counters):
+                lines.append("# TYPE "+Metrics.PREFIX+name+"_total counter")
+                lines.append(Metrics.PREFIX+name+"_total "+str(self.counters[name]))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                lines.append("# TYPE "+Metrics.PREFIX+name+" histogram")
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(Metrics.PREFIX+name+'_bucket{le="'+repr(bound)+'"} '+str(cumulative))
+                lines.append(Metrics.PREFIX+name+'_bucket{le="+Inf"} '+str(histogram.count))
+                lines.append(Metrics.PREFIX+name+"_sum "+repr(histogram.sum))
+                lines.append(Metrics.PREFIX+name+"_count "+str(histogram.count))
+            return "\n".join(lines)+"\n"
+
+METRICS=Metrics()
+
+# the status changes of the models, numbered from 1 in the order they were received, for the consumers that
+# follow them incrementally. The last CAPACITY are kept, each one already encoded in json: a consumer that fell
+# further behind is told it missed some and starts again from a snapshot
+class ChangeFeed:
+    CAPACITY=10000
+
+    def __init__(self, capacity=CAPACITY):
+        self._events = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self.last_seq = 0
+
+    # called from the threads reading the sessions
+    def publish(self, model, status, event_time, not_existing=False):
+        if not_existing:
+            event = DesktopNotifier.EVENTS.NOT_EXISTING
+        elif status == MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE:
+            event = DesktopNotifier.EVENTS.ONLINE
+        elif status == MFCProtocol.STATUS_CODES.FCVIDEO_UNKNOWN:
+            event = DesktopNotifier.EVENTS.OFFLINE
+        else:
+            event = DesktopNotifier.EVENTS.LIMBO
+        with self._condition:
+            self.last_seq += 1
+            self._events.append((self.last_seq, json.dumps({
+                    "seq": self.last_seq, "time": event_time, "model": model.name, "uid": model.uid, "event": event,
+                    "status": MFCProtocol.status_label(status) if status is not None else None,
+                    "tenants": [tenant.id for tenant in model.watchers]})))
+            self._condition.notify_all()
+
+    # (seq, json) of the events after seq, waiting up to timeout for one, the last seq and whether events after
+    # seq were dropped. A seq from a previous run, above the last one, also counts as missed
+    def since(self, seq, timeout=0.0):
+        deadline = time.time()+timeout
+        with self._condition:
+            while seq == self.last_seq:
+                remaining = deadline-time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            first = self.last_seq-len(self._events)+1
+            missed = seq+1 < first or seq > self.last_seq
+            start = max(0, seq+1-first) if seq <= self.last_seq else 0
+            return list(itertools.islice(self._events, start, None)), self.last_seq, missed
+
+# the current state of all the models in json, rebuilt at most once per MAX_AGE unless the feed or the
+# registry changed. The seq tells which events it already includes, a consumer follows the feed from there
+class StatusSnapshot:
+    MAX_AGE=5.0
+
+    def __init__(self, models, feed):
+        self.models = models
+        self.feed = feed
+        self._lock = threading.Lock()
+        self._key = None
+        self._built = 0
+        self._body = None
+
+    def json(self):
+        with self._lock:
+            # read first: the snapshot is at least as recent as the feed at that time
+            key = (self.feed.last_seq, self.models.version)
+            now = time.time()
+            if self._body is None or key != self._key or now-self._built > StatusSnapshot.MAX_AGE:
+                self._body = json.dumps({"seq": key[0], "time": now, "models": [{
+                        "model": model.name, "uid": model.uid, "online": model.isOnline, "not_existing": model.notExisting,
+                        "status": MFCProtocol.status_label(model.status) if model.status is not None else None,
+                        "last_seen": model.lastSeen, "last_change": model.lastChange,
+                        "tenants": [tenant.id for tenant in model.watchers]} for model in self.models.snapshot()]})
+                self._key = key
+                self._built = now
+                METRICS.inc("status_snapshots_built")
+            return self._body
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# serves on the given local port, each request from a thread of its own:
+#   /metrics                    the metrics in the prometheus text format
+#   /changes?since=<seq>        the status changes after seq in json, waiting up to timeout (default 30) seconds for one
+#   /events?since=<seq>         the status changes as server-sent events, the last seq can also be in Last-Event-ID
+#   /snapshot                   the state of all the models in json
+class MetricsServer(threading.Thread):
+    LONG_POLL_TIMEOUT=30.0
+    MAX_LONG_POLL_TIMEOUT=300.0
+    KEEPALIVE_INTERVAL=15.0
+
+    def __init__(self, port, host="127.0.0.1", feed=None, snapshot=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                parameters = parse_qs(url.query)
+                try:
+                    if url.path == "/metrics":
+                        self._reply("text/plain; version=0.0.4", METRICS.prometheus())
+                    elif url.path == "/changes" and feed is not None:
+                        timeout = float(parameters.get("timeout", [MetricsServer.LONG_POLL_TIMEOUT])[0])
+                        # nan is neither below nor above the bounds, it would wait forever
+                        if isnan(timeout) or isinf(timeout):
+                            raise ValueError("timeout "+str(timeout))
+                        timeout = min(max(timeout, 0.0), MetricsServer.MAX_LONG_POLL_TIMEOUT)
+                        events, last_seq, missed = feed.since(int(parameters.get("since", [0])[0]), timeout)
+                        self._reply("application/json", '{"seq": %d, "missed": %s, "events": [%s]}' % (
+                                last_seq, "true" if missed else "false", ", ".join(event for seq, event in events)))
+                    elif url.path == "/events" and feed is not None:
+                        self._stream(int(parameters.get("since", [self.headers.get("Last-Event-ID", 0)])[0]))
+                    elif url.path == "/snapshot" and snapshot is not None:
+                        self._reply("application/json", snapshot.json())
+                    else:
+                        self.send_error(404)
+                except ValueError:
+                    self.send_error(400)
+
+            def _reply(self, content_type, body):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # until the consumer disconnects
+            def _stream(self, seq):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                METRICS.inc("event_streams")
+                try:
+                    while True:
+                        events, last_seq, missed = feed.since(seq, MetricsServer.KEEPALIVE_INTERVAL)
+                        if missed:
+                            self.wfile.write("event: missed\ndata: {\"seq\": %d}\n\n" % last_seq)
+                        if events:
+                            self.wfile.write("".join("id: %d\ndata: %s\n\n" % event for event in events))
+                        elif not missed:
+                            self.wfile.write(": keepalive\n\n")
+                        self.wfile.flush()
+                        seq = events[-1][0] if events else last_seq
+                except IOError:
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+        self._server = ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+# samples the stacks of all threads, the time of a function is estimated from the number of samples it is in
+class SamplingProfiler(threading.Thread):
+    INTERVAL=0.005
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # the command line waits for input most of the time, its samples are left out
+        self._ignored_thread = threading.current_thread().ident
+        self.samples = 0
+        # samples with the function at the top of the stack, and anywhere in the stack
+        self.own = {}
+        self.cumulative = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        ignored = (threading.current_thread().ident, self._ignored_thread)
+        while not self._stopped.wait(SamplingProfiler.INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                # idle threads wait on a condition (queues, events, the scheduler)
+                if thread_id in ignored or (frame.f_code.co_name == "wait" and frame.f_code.co_filename.endswith("threading.py")):
+                    continue
+                self.samples += 1
+                key = SamplingProfiler._key(frame)
+                self.own[key] = self.own.get(key, 0)+1
+                seen = set()
+                while frame is not None:
+                    key = SamplingProfiler._key(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        self.cumulative[key] = self.cumulative.get(key, 0)+1
+                    frame = frame.f_back
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def report(self, limit=20):
+        if not self.samples:
+            return ["No samples"]
+        lines = [str(self.samples)+" samples of threads not waiting, every "+str(SamplingProfiler.INTERVAL)+" seconds", "   own    cumul  function"]
+        for key, count in sorted(self.cumulative.iteritems(), key=lambda item: -item[1])[:limit]:
+            lines.append("%5.1f%%  %5.1f%%  %s" % (100.0*self.own.get(key, 0)/self.samples, 100.0*count/self.samples, key))
+        return lines
+
+    @staticmethod
+    def _key(frame):
+        code = frame.f_code
+        return code.co_name+" ("+path.basename(code.co_filename)+":"+str(code.co_firstlineno)+")"
+
+# sends the desktop notifications from its own thread, notifications about the same kind of
+# transition that arrive within the window are sent as a single summary
+class DesktopNotifier(threading.Thread):
+
+    EVENTS=enum(
+            ONLINE = "ONLINE",
+            OFFLINE = "OFFLINE",
+            LIMBO = "LIMBO",
+            NOT_EXISTING = "NOT_EXISTING")
+    EVENT_SUMMARY = {
+            EVENTS.ONLINE : "models came online",
+            EVENTS.OFFLINE : "models have gone offline",
+            EVENTS.LIMBO : "models are in limbo",
+            EVENTS.NOT_EXISTING : "models do not seem to exist"
+            }
+    SUMMARY="MFC online checker"
+    MAX_QUEUE_SIZE=1000
+    MAX_NAMES_IN_SUMMARY=20
+
+    def __init__(self, window=2.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.window = window
+        self.stopped = False
+        self._queue = Queue(maxsize=DesktopNotifier.MAX_QUEUE_SIZE)
+
+    # notification is an optional (event, model name) tuple, only those are coalesced
+    def notify(self, text, notification=None):
+        try:
+            self._queue.put_nowait((text, notification))
+        except Full:
+            pass
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            pass
+
+    def run(self):
+        while not self.stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time()+self.window
+            while not self.stopped:
+                remaining = deadline-time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            if self.stopped:
+                break
+            for body in self._coalesce(batch):
+                # notify-send missing or failing does not stop the notifications that follow
+                try:
+                    DesktopNotifier.send(body)
+                except OSError as exc:
+                    METRICS.inc("notification_errors")
+                    LOGGER.printline("Unable to send the desktop notification: "+str(exc), log_level=Logger.LOG_LEVELS.DEBUG)
+
+    def _coalesce(self, batch):
+        result = []
+        events = OrderedDict()
+        for text, notification in batch:
+            if notification is None:
+                result.append(text)
+            else:
+                events.setdefault(notification[0], []).append((text, notification[1]))
+        for event, items in events.iteritems():
+            if len(items) == 1:
+                result.append(items[0][0])
+                continue
+            names = [name for text, name in items]
+            body = str(len(names))+" "+DesktopNotifier.EVENT_SUMMARY[event]+": "+", ".join(names[:DesktopNotifier.MAX_NAMES_IN_SUMMARY])
+            if len(names) > DesktopNotifier.MAX_NAMES_IN_SUMMARY:
+                body += " and "+str(len(names)-DesktopNotifier.MAX_NAMES_IN_SUMMARY)+" more"
+            result.append(body)
+        return result
+
+    @staticmethod
+    def send(body):
+        METRICS.inc("notifications_sent")
+        call(["notify-send", DesktopNotifier.SUMMARY, body])
+
+# one per watched model, without instance dict: 100k+ of them are kept in memory
+class MFCModel(object):
+    __slots__ = ("name", "uid", "isOnline", "isMuted", "isChecked", "status", "lastSeen", "lastQueried", "lastChange",
+                 "nextDue", "pendingSince", "noReply", "notExisting", "watchers")
+
     def __init__(self,name):
-        self.name = name
+        # the same string object for the model in the registry, its shard and the queues
+        self.name = intern(name.encode("utf-8") if isinstance(name, unicode) else name)
+        # user id on MFC, learned from the replies. Pushed updates may only carry the uid
+        self.uid = None
         self.isOnline = False
         self.isMuted = False
         self.isChecked = False
+        # last received video status code
+        self.status = None
+        self.lastSeen = None
+        self.lastQueried = None
+        # when the status last changed, drives how often the model is queried
+        self.lastChange = None
+        # time of the pending query, set by the PollScheduler
+        self.nextDue = None
+        # first query sent since the last reply, None when there is no query waiting for a reply
+        self.pendingSince = None
+        # the last queries for this model timed out without reply
+        self.noReply = False
+        # MFC replied that this model does not exist
+        self.notExisting = False
+        # the tenants watching the model, empty when the registry is used without tenants
+        self.watchers = ()
 
     def __str__(self):
         string = self.name
@@ -83,7 +643,359 @@ class MFCModel:
             string += " (muted)"
         return string
 
-class MFCClient(WebSocketClient):
+# pulls consecutive json objects out of the unquoted message data, an object that is
+# split over several messages is kept until the rest of it has been received
+class JsonStreamDecoder:
+    MAX_PENDING=65536
+    STRING_OR_BRACE=re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}]')
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._pending = ""
+
+    def feed(self,data):
+        if self._pending:
+            data = self._pending+data
+            self._pending = ""
+
+        result=[]
+        idx=data.find("{")
+        while idx != -1:
+            try:
+                obj, end = self._decoder.raw_decode(data, idx)
+            except ValueError:
+                end = self._objectEnd(data, idx)
+                if end == -1:
+                    end = self._nextObject(data, idx)
+                    if end == -1:
+                        # the data ends inside the object, the rest of it is in the next message
+                        if len(data)-idx <= JsonStreamDecoder.MAX_PENDING:
+                            self._pending = data[idx:]
+                        else:
+                            LOGGER.printline("Dropping incomplete message from MFC: "+data[idx:idx+80], log_level=Logger.LOG_LEVELS.ERROR)
+                        break
+                    # a complete object follows, the one before it was truncated and is never completed
+                    LOGGER.printline("Error decoding received message from MFC: "+data[idx:end], log_level=Logger.LOG_LEVELS.ERROR)
+                    idx = end
+                    continue
+                LOGGER.printline("Error decoding received message from MFC: "+data[idx:end], log_level=Logger.LOG_LEVELS.ERROR)
+            else:
+                result.append(obj)
+            idx=data.find("{", end)
+        return result
+
+    # only used when decoding failed: tells a malformed object (returns its end) from an incomplete one (-1)
+    def _objectEnd(self,data,start):
+        count=0
+        for match in JsonStreamDecoder.STRING_OR_BRACE.finditer(data, start):
+            token = match.group()
+            if token == "{":
+                count += 1
+            elif token == "}":
+                count -= 1
+                if count == 0:
+                    return match.end()
+            elif token == '"':
+                # unterminated string
+                return -1
+        return -1
+
+    # start of the first complete object after an unclosed one at start, -1 if there is none. An object that is
+    # the value of a member or of an array is part of the unclosed one. Quotes are not paired here, the unclosed
+    # object may end inside a string
+    def _nextObject(self,data,start):
+        idx=data.find("{", start+1)
+        while idx != -1:
+            before = idx-1
+            while data[before] in " \t\r\n":
+                before -= 1
+            if data[before] not in ":,[":
+                try:
+                    self._decoder.raw_decode(data, idx)
+                    return idx
+                except ValueError:
+                    pass
+            idx=data.find("{", idx+1)
+        return -1
+
+# one watchlist of a process shared by several teams, with its own mute state and notification settings,
+# stored under its application_id. A model watched by several tenants is still queried once
+class Tenant:
+
+    def __init__(self, tenant_id, desktop_notifications=True, display_transition_to_offline=True):
+        self.id = tenant_id
+        self.desktop_notifications = desktop_notifications
+        self.display_transition_to_offline = display_transition_to_offline
+        # names of the watched models and of the muted ones among them
+        self.models = set()
+        self.muted = set()
+        # tenant 0 is the only one of a single team process, its messages are shown as before
+        self.prefix = "[tenant "+str(tenant_id)+"] " if tenant_id != 0 else ""
+
+    def __str__(self):
+        return "tenant "+str(self.id)
+
+    def label(self, model):
+        if model.name in self.muted:
+            return model.name+" (muted)"
+        return model.name
+
+# one version of the watchlist, never changed once published. Readers take the current one without lock and
+# see the models, their order and their shards consistent with each other. The state of each model is not part of it
+class RegistrySnapshot(object):
+    __slots__ = ("version", "models", "ordered", "shards", "shard_of")
+
+    def __init__(self, version, models, ordered, shards, shard_of):
+        self.version = version
+        # name to model, and the models in the order they were added
+        self.models = models
+        self.ordered = ordered
+        # one name to model dict per shard, the order within a shard does not matter
+        self.shards = shards
+        self.shard_of = shard_of
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def __len__(self):
+        return len(self.ordered)
+
+# name-keyed index of the models to check, shared by the application and its websocket clients.
+# The models are spread over shards of equal size (within one), each shard is checked by its own session.
+# Changes are copied on write: the writers take turns building the next snapshot and publish it at once,
+# the receiving threads and the status views never wait on them
+class MFCModelRegistry:
+
+    def __init__(self, model_names=(), shard_count=1):
+        self._snapshot = RegistrySnapshot(0, {}, (), tuple({} for i in range(shard_count)), {})
+        # changed in place: the first reply of each model sets its uid, copying the index for each of them would
+        # cost too much. A lookup only needs its own entry
+        self._by_uid = {}
+        # only taken by the writers
+        self._lock = threading.Lock()
+        self.addAll(model_names)
+
+    # incremented with each published snapshot
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    # for several reads of the same version
+    def snapshot(self):
+        return self._snapshot
+
+    def __iter__(self):
+        return iter(self._snapshot.ordered)
+
+    def __len__(self):
+        return len(self._snapshot.ordered)
+
+    def __contains__(self, model_name):
+        return model_name in self._snapshot.models
+
+    def get(self, model_name):
+        return self._snapshot.models.get(model_name)
+
+    def add(self, model_name):
+        added = self.addAll([model_name])
+        return added[0] if added else None
+
+    # returns the models that were not in the registry yet, or with a tenant the ones it did not watch yet.
+    # Only the models new to the registry have to be queried, they are published in a single snapshot
+    def addAll(self, model_names, tenant=None):
+        added = []
+        created = []
+        with self._lock:
+            snapshot = self._snapshot
+            models = snapshot.models
+            for model_name in model_names:
+                model = models.get(model_name)
+                if model is None:
+                    if not created:
+                        models = dict(models)
+                    model = MFCModel(model_name)
+                    models[model.name] = model
+                    created.append(model)
+                elif tenant is None or tenant in model.watchers:
+                    continue
+                if tenant is not None:
+                    model.watchers += (tenant,)
+                    tenant.models.add(model.name)
+                    model.isMuted = False
+                added.append(model)
+            if created:
+                shards = [dict(shard) for shard in snapshot.shards]
+                shard_of = dict(snapshot.shard_of)
+                for model in created:
+                    self._addToShard(shards, shard_of, model, min(range(len(shards)), key=lambda i: len(shards[i])))
+                self._publish(models, snapshot.ordered+tuple(created), shards, shard_of)
+        return added
+
+    # with a tenant, the model stays in the registry while other tenants watch it.
+    # Returns the model when it was removed from the tenant, or from the registry without tenant
+    def remove(self, model_name, tenant=None):
+        with self._lock:
+            snapshot = self._snapshot
+            model = snapshot.models.get(model_name)
+            if model is None:
+                return None
+            if tenant is not None:
+                if tenant not in model.watchers:
+                    return None
+                model.watchers = tuple(watcher for watcher in model.watchers if watcher is not tenant)
+                if model.watchers:
+                    tenant.models.discard(model.name)
+                    tenant.muted.discard(model.name)
+                    model.isMuted = self._mutedByAll(model)
+                    return model
+            for watcher in model.watchers+((tenant,) if tenant is not None else ()):
+                watcher.models.discard(model.name)
+                watcher.muted.discard(model.name)
+            models = dict(snapshot.models)
+            del models[model_name]
+            shards = list(snapshot.shards)
+            shard_of = dict(snapshot.shard_of)
+            shard = shard_of.pop(model_name)
+            shards[shard] = dict(shards[shard])
+            del shards[shard][model_name]
+            if model.uid is not None and self._by_uid.get(model.uid) is model:
+                del self._by_uid[model.uid]
+            self._rebalance(shards, shard_of)
+            self._publish(models, tuple(other for other in snapshot.ordered if other is not model), shards, shard_of)
+            return model
+
+    def getByUid(self, uid):
+        return self._by_uid.get(uid)
+
+    def setUid(self, model, uid):
+        with self._lock:
+            if self._snapshot.models.get(model.name) is not model:
+                return
+            if model.uid is not None:
+                self._by_uid.pop(model.uid, None)
+            model.uid = uid
+            self._by_uid[uid] = model
+
+    def online(self, include_muted=True, tenant=None):
+        return [model for model in self._snapshot.ordered if model.isOnline and self._visible(model, include_muted, tenant)]
+
+    def offline(self, include_muted=True, tenant=None):
+        return [model for model in self._snapshot.ordered if not model.isOnline and self._visible(model, include_muted, tenant)]
+
+    # the models of a tenant, in the order they were added to the registry
+    def watchedBy(self, tenant):
+        return [model for model in self._snapshot.ordered if tenant in model.watchers]
+
+    def _visible(self, model, include_muted, tenant):
+        if tenant is None:
+            return include_muted or not model.isMuted
+        return tenant in model.watchers and (include_muted or model.name not in tenant.muted)
+
+    # models whose status changed at or after the given time
+    def changedSince(self, since):
+        return [model for model in self._snapshot.ordered if model.lastChange is not None and model.lastChange >= since]
+
+    def shard(self, shard):
+        return self._snapshot.shards[shard].values()
+
+    def shardCount(self):
+        return len(self._snapshot.shards)
+
+    def shardOf(self, model_name):
+        return self._snapshot.shard_of.get(model_name)
+
+    def setShardCount(self, shard_count):
+        with self._lock:
+            snapshot = self._snapshot
+            shards = [{} for i in range(shard_count)]
+            shard_of = {}
+            for i, model in enumerate(snapshot.ordered):
+                self._addToShard(shards, shard_of, model, i % shard_count)
+            self._publish(snapshot.models, snapshot.ordered, shards, shard_of)
+
+    def _publish(self, models, ordered, shards, shard_of):
+        self._snapshot = RegistrySnapshot(self._snapshot.version+1, models, ordered, tuple(shards), shard_of)
+
+    @staticmethod
+    def _addToShard(shards, shard_of, model, shard):
+        shards[shard][model.name] = model
+        shard_of[model.name] = shard
+
+    # a removal unbalances the shards by at most one model, moving one model restores the balance.
+    # The shards have already been copied, except the largest one
+    def _rebalance(self, shards, shard_of):
+        largest = max(range(len(shards)), key=lambda i: len(shards[i]))
+        smallest = min(range(len(shards)), key=lambda i: len(shards[i]))
+        if len(shards[largest])-len(shards[smallest]) > 1:
+            shards[largest] = dict(shards[largest])
+            model_name, model = shards[largest].popitem()
+            self._addToShard(shards, shard_of, model, smallest)
+
+    # with a tenant, only muted for that tenant. The model counts as muted once all its tenants muted it
+    def mute(self, model_name, tenant=None):
+        with self._lock:
+            model = self._snapshot.models.get(model_name)
+            if model is not None:
+                if tenant is not None:
+                    tenant.muted.add(model.name)
+                    model.isMuted = self._mutedByAll(model)
+                else:
+                    model.isMuted = True
+            return model
+
+    def unmute(self, model_name, tenant=None):
+        with self._lock:
+            model = self._snapshot.models.get(model_name)
+            if model is not None:
+                if tenant is not None:
+                    tenant.muted.discard(model.name)
+                model.isMuted = False
+            return model
+
+    def _mutedByAll(self, model):
+        for watcher in model.watchers:
+            if model.name not in watcher.muted:
+                return False
+        return True
+
+# appends the frames of the sessions to a file, one per line: time, direction and the frame as sent or received.
+# The watched models, with their uid when known, are written when the recording starts
+class FrameRecorder:
+    RECEIVED="<"
+    SENT=">"
+    WATCHED="="
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, direction, frame):
+        line = "%.3f %s %s\n" % (time.time(), direction, frame.rstrip("\n\0"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+    def recordModels(self, models):
+        self.record(FrameRecorder.WATCHED, " ".join(model.name+(":"+str(model.uid) if model.uid is not None else "") for model in models))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # (time, direction, frame) of each recorded frame
+    @staticmethod
+    def read(path):
+        with open(path) as recording:
+            for line in recording:
+                fields = line.rstrip("\n").split(" ", 2)
+                if len(fields) == 3:
+                    yield float(fields[0]), fields[1], fields[2]
+
+# the fcserver protocol, shared by the websocket clients of both engines
+class MFCProtocol(object):
 
     STATUS_CODES=enum(
             FCVIDEO_TX_IDLE = 0,
@@ -99,116 +1011,525 @@ class MFCClient(WebSocketClient):
             FCVIDEO_RX_GRP = 93,
             FCVIDEO_UNKNOWN = 127)
 
+    HEARTBEAT_INTERVAL=10.0
+    # queries sent and not yet answered, per session
+    MAX_IN_FLIGHT=100
+    # a query without reply after this many seconds is sent again, at most MAX_QUERY_ATTEMPTS times in total
+    QUERY_TIMEOUT=10.0
+    MAX_QUERY_ATTEMPTS=3
+    # models that did not exist are only queried again after this many seconds
+    NOT_EXISTING_RECHECK_INTERVAL=3600.0
+    # frames the server sends on its own when the state of a user changes (SESSIONSTATE)
+    PUSH_TYPES=("20",)
+    # name and uid in the quoted data of a pushed frame, to skip the users that are not watched without decoding
+    QUOTED_NAME=re.compile(r'%22nm%22%3A(?:%20)?%22([^%]*)%22')
+    QUOTED_UID=re.compile(r'%22uid%22%3A(?:%20)?([0-9]+)')
+
     sessionId = ""
-    models=[]
+    models=None
     desktop_notify_enabled=True
     display_transition_to_offline=True
+    shard=0
+    # notified when the session logs in and when it is closed
+    listener=None
+    status_history=None
+    change_feed=None
+    recorder=None
+    opened_at=0
+    login_rtt=None
+    logged_in_at=None
+    # time of the last frame received, of any type
+    last_received=0
+    # time of the last status pushed by the server
+    last_push=0
+    reply_latency_total=0.0
+    reply_count=0
+
+    def _initProtocol(self):
+        self._json_decoder = JsonStreamDecoder()
+        # queries waiting for their reply, by request id (echoed in arg1 of the reply), oldest first
+        self._pending = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        # the scheduler, the receiving thread and the command line all write on the same socket
+        self._send_lock = threading.Lock()
+
+    def send(self, payload, binary=False):
+        METRICS.inc("frames_sent")
+        if self.recorder is not None:
+            self.recorder.record(FrameRecorder.SENT, payload)
+        with self._send_lock:
+            WebSocket.send(self, payload, binary)
 
     def opened(self):
+        self.opened_at = time.time()
         self.send("hello fcserver\n\0")
         self.send("1 0 0 1 0 guest:guest\n\0")
 
     def closed(self, code, reason=None):
         LOGGER.printline("Websocket closed", log_level=Logger.LOG_LEVELS.DEBUG)
+        if self.listener is not None:
+            self.listener.sessionClosed(self)
 
-    def received_message(self, m):
-        msg=m.data[4:]
-        msgs=msg.split(' ')
-        msg_type = msg_from = msg_to = msg_arg1 = msg_arg2 = msg_data = ""
-        if len(msgs) >= 5:
-            msg_type = msgs[0]
-            msg_from = msgs[1]
-            msg_to   = msgs[2]
-            msg_arg1 = msgs[3]
-            msg_arg2 = msgs[4]
-        if len(msgs) > 5:
-            msg_data = unquote(' '.join(msgs[5:]))
-
-        LOGGER.printline("Received: "+m.data, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("Message: "+msg_type, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("From: "+msg_from, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("To: "+msg_to, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("Arg1: "+msg_arg1, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("Arg2: "+msg_arg2, log_level=Logger.LOG_LEVELS.DEBUG)
-        LOGGER.printline("Data: "+msg_data, log_level=Logger.LOG_LEVELS.DEBUG)
+    def isLoggedIn(self):
+        return self.sessionId != "" and not self.terminated
+
+    # a frame is a 4 digit length followed by: type from to arg1 arg2 [data], the data is url quoted.
+    # Returns the five header fields and the data as received, None for a frame without all the fields
+    @staticmethod
+    def decode_frame(frame):
+        fields = frame[4:].split(' ', 5)
+        if len(fields) < 5:
+            return None
+        if len(fields) == 5:
+            fields.append("")
+        return fields
 
+    def received_message(self, m):
+        if self.recorder is not None:
+            self.recorder.record(FrameRecorder.RECEIVED, m.data)
+        fields = MFCProtocol.decode_frame(m.data)
+        METRICS.inc("frames_received")
+        self.last_received = time.time()
+        debug = LOGGER.is_enabled(Logger.LOG_LEVELS.DEBUG)
+        if debug:
+            LOGGER.printline("Received: "+m.data, log_level=Logger.LOG_LEVELS.DEBUG)
+        if fields is None:
+            return
+        msg_type, msg_from, msg_to, msg_arg1, msg_arg2, msg_data = fields
+        if debug:
+            LOGGER.printline("Message: "+msg_type, log_level=Logger.LOG_LEVELS.DEBUG)
+            LOGGER.printline("From: "+msg_from, log_level=Logger.LOG_LEVELS.DEBUG)
+            LOGGER.printline("To: "+msg_to, log_level=Logger.LOG_LEVELS.DEBUG)
+            LOGGER.printline("Arg1: "+msg_arg1, log_level=Logger.LOG_LEVELS.DEBUG)
+            LOGGER.printline("Arg2: "+msg_arg2, log_level=Logger.LOG_LEVELS.DEBUG)
+            LOGGER.printline("Data: "+unquote(msg_data), log_level=Logger.LOG_LEVELS.DEBUG)
+
+        # only the data of the handled types is unquoted and decoded
         if msg_type == "1":
             self.sessionId = msg_to
-            LOGGER.printline("Logged in "+self.sessionId, log_level=Logger.LOG_LEVELS.DEBUG)
-            self._check()
+            self.logged_in_at = time.time()
+            self.login_rtt = self.logged_in_at-self.opened_at
+            METRICS.observe("login_rtt_seconds", self.login_rtt)
+            LOGGER.printline("Logged in %s", log_level=Logger.LOG_LEVELS.DEBUG, args=self.sessionId)
+            # the listener decides when the models are queried, on its own a session checks all of its shard
+            if self.listener is not None:
+                self.listener.sessionLoggedIn(self)
+            else:
+                self._check()
             return
-            
-        if msg_data != "":
-            for i in self._getJsonPartsFromData(msg_data):
-                try:
-                    data_json=json.loads(i)
-                    LOGGER.printline(json.dumps(data_json, sort_keys=True, indent=4, separators=(',', ': ')), log_level=Logger.LOG_LEVELS.DEBUG)
-                except ValueError:
-                    LOGGER.printline("Error decoding received message from MFC: "+i, log_level=Logger.LOG_LEVELS.ERROR)
-                    continue
 
-                model_name=data_json["nm"]
-                model_status=data_json["vs"]
-                model = self.getModel(model_name)
-                if not model:
-                    LOGGER.printline("Unexpected MFC response (unrequested model name): "+model_name,log_level=Logger.LOG_LEVELS.ERROR)
-                    return
+        received_at = time.time()
+        if msg_type == "10":
+            with self._pending_lock:
+                request = self._pending.pop(msg_arg1, None)
+            if request is not None:
+                self.reply_latency_total += received_at-request[1]
+                self.reply_count += 1
+                METRICS.observe("reply_latency_seconds", received_at-request[1])
+            # the data is the queried name instead of the model details
+            if msg_arg2 == "1":
+                model = request[0] if request is not None else self.getModel(unquote(msg_data))
+                if model is not None:
+                    self._notExisting(model)
+                return
+
+        pushed = msg_type in MFCProtocol.PUSH_TYPES
+        if pushed and not self._watchedPush(msg_data):
+            return
+        if msg_data != "" and (pushed or msg_type == "10"):
+            objects = self._json_decoder.feed(unquote(msg_data))
+            METRICS.inc("json_objects", len(objects))
+            for data_json in objects:
+                if debug:
+                    LOGGER.printline(json.dumps(data_json, sort_keys=True, indent=4, separators=(',', ': ')), log_level=Logger.LOG_LEVELS.DEBUG)
 
-                if model_status == MFCClient.STATUS_CODES.FCVIDEO_TX_IDLE:
-                    if not model.isOnline:
-                        model.isOnline = True
-                        if not model.isMuted:
-                            LOGGER.printline("Model "+model.name+" is now online", desktop_notify=self.desktop_notify_enabled, log_level=Logger.LOG_LEVELS.INFO)
+                # pushed updates only name the user in some of the frames, the uid is always there
+                model_name = data_json.get("nm")
+                uid = data_json.get("uid")
+                model = self.getModel(model_name) if model_name is not None else None
+                if model is None and uid is not None:
+                    model = self.models.getByUid(uid)
+                if model is None:
+                    # the server pushes the updates of all users, most of them are not watched
+                    if not pushed:
+                        LOGGER.printline("Unexpected MFC response (unrequested model name): "+str(model_name),log_level=Logger.LOG_LEVELS.ERROR)
+                    continue
+                if uid is not None and model.uid != uid:
+                    self.models.setUid(model, uid)
+                if "vs" not in data_json:
+                    continue
+                if pushed:
+                    self.last_push = received_at
+                    METRICS.inc("pushed_updates")
+                self._updateModel(model, data_json["vs"], received_at)
+
+    def _watchedPush(self, data):
+        uid = MFCProtocol.QUOTED_UID.search(data)
+        if uid is not None and self.models.getByUid(int(uid.group(1))) is not None:
+            return True
+        name = MFCProtocol.QUOTED_NAME.search(data)
+        if name is not None:
+            return name.group(1) in self.models
+        # without name nor uid the data has to be decoded to tell
+        return uid is None
+
+    def _updateModel(self, model, model_status, received_at):
+        previous_status = model.status
+        model.lastSeen = received_at
+        model.pendingSince = None
+        model.noReply = False
+        model.notExisting = False
+        if model_status != previous_status:
+            model.status = model_status
+            METRICS.inc("status_changes")
+            if previous_status is not None:
+                model.lastChange = received_at
+            if self.status_history is not None:
+                self.status_history.record(model.name, model_status, received_at)
+            if self.change_feed is not None:
+                self.change_feed.publish(model, model_status, received_at)
+
+        if model_status == MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE:
+            if not model.isOnline:
+                model.isOnline = True
+                self._notify(model, "Model "+model.name+" is now online", Logger.LOG_LEVELS.INFO, DesktopNotifier.EVENTS.ONLINE)
+        else:
+            if model.isOnline:
+                model.isOnline = False
+                if model_status == MFCProtocol.STATUS_CODES.FCVIDEO_UNKNOWN:
+                    self._notify(model, "Model "+model.name+" has gone offline", Logger.LOG_LEVELS.INFO, DesktopNotifier.EVENTS.OFFLINE, offline=True)
                 else:
-                    if model.isOnline:
-                        model.isOnline = False
-                        if self.display_transition_to_offline:
-                            if not model.isMuted:
-                                if model_status == MFCClient.STATUS_CODES.FCVIDEO_UNKNOWN:
-                                    LOGGER.printline("Model "+model.name+" has gone offline", desktop_notify=self.desktop_notify_enabled, log_level=Logger.LOG_LEVELS.INFO)
-                                else:
-                                    LOGGER.printline("Model "+model.name+" has gone in limbo", desktop_notify=self.desktop_notify_enabled, log_level=Logger.LOG_LEVELS.INFO)
-                    else:
-                        if not model.isMuted and not model.isChecked and model_status != MFCClient.STATUS_CODES.FCVIDEO_UNKNOWN:
-                            LOGGER.printline("Model "+model.name+" is in limbo", desktop_notify=self.desktop_notify_enabled, log_level=Logger.LOG_LEVELS.INFO)
-                model.isChecked = True
+                    self._notify(model, "Model "+model.name+" has gone in limbo", Logger.LOG_LEVELS.INFO, DesktopNotifier.EVENTS.LIMBO, offline=True)
+            else:
+                if previous_status is None and model_status != MFCProtocol.STATUS_CODES.FCVIDEO_UNKNOWN:
+                    self._notify(model, "Model "+model.name+" is in limbo", Logger.LOG_LEVELS.INFO, DesktopNotifier.EVENTS.LIMBO)
+        model.isChecked = True
+
+    # shown once to each tenant watching the model that did not mute it, offline transitions only to the
+    # tenants that want them. Without tenants, shown once unless the model is muted
+    def _notify(self, model, text, log_level, event, offline=False):
+        if not model.watchers:
+            if not model.isMuted and (not offline or self.display_transition_to_offline):
+                LOGGER.printline(text, desktop_notify=self.desktop_notify_enabled, log_level=log_level, notification=(event, model.name))
+            return
+        for tenant in model.watchers:
+            if model.name in tenant.muted or (offline and not tenant.display_transition_to_offline):
+                continue
+            LOGGER.printline(tenant.prefix+text, desktop_notify=self.desktop_notify_enabled and tenant.desktop_notifications, log_level=log_level, notification=(event, model.name))
 
     def getModel(self,model_name):
-        return next((model for model in self.models if model.name==model_name), None)
+        return self.models.get(model_name)
+
+    def _notExisting(self, model):
+        METRICS.inc("not_existing_replies")
+        model.isChecked = True
+        model.pendingSince = None
+        model.noReply = False
+        if not model.notExisting:
+            model.notExisting = True
+            if self.change_feed is not None:
+                self.change_feed.publish(model, None, time.time(), not_existing=True)
+            self._notify(model, "Model "+model.name+" does not exist", Logger.LOG_LEVELS.WARN, DesktopNotifier.EVENTS.NOT_EXISTING)
+
+    def inFlight(self):
+        return len(self._pending)
+
+    # removes the queries sent before the given time that are still without reply, returns (model, sent_at, attempt) of each
+    def expireQueries(self, sent_before):
+        expired = []
+        with self._pending_lock:
+            while self._pending:
+                request_id, (model, sent_at, attempt) = next(self._pending.iteritems())
+                if sent_at > sent_before:
+                    break
+                del self._pending[request_id]
+                expired.append((model, sent_at, attempt))
+        return expired
+
+    # average time between sending a query and receiving its reply, since the previous call
+    def takeReplyLatency(self):
+        latency = self.reply_latency_total/self.reply_count if self.reply_count else None
+        self.reply_latency_total = 0.0
+        self.reply_count = 0
+        return latency
 
-    def check_consistency(self):
-        for model in filter(lambda x: not x.isChecked, self.models):
-            LOGGER.printline("It seems that model "+model.name+" does not exist", desktop_notify=self.desktop_notify_enabled, log_level=Logger.LOG_LEVELS.WARN)
+    @staticmethod
+    def status_label(status):
+        for name, value in vars(MFCProtocol.STATUS_CODES).iteritems():
+            if value == status:
+                return name
+        return str(status)
 
     def _heartbeat(self):
-        threading.Timer(10.0, self.heartbeat).start()
-        if self.sessionId != "":
-            LOGGER.printline("Send hartbeat "+self.sessionId, log_level=Logger.LOG_LEVELS.DEBUG)
+        if self.isLoggedIn():
+            LOGGER.printline("Send hartbeat %s", log_level=Logger.LOG_LEVELS.DEBUG, args=self.sessionId)
             self.send("0 "+self.sessionId+" 0 0 0\n\0")
 
     def _check(self):
         # could possibly change this to only send requests for not muted models (and remove the test on isMuted in the response handling)
-        for model in self.models:
-            LOGGER.printline("Send info request for model "+str(model), log_level=Logger.LOG_LEVELS.DEBUG)
-            self.send("10 "+self.sessionId+" 0 20 0 "+model.name+"\n\0")
+        now = time.time()
+        for model in self.models.shard(self.shard):
+            if model.notExisting and model.lastQueried is not None and now-model.lastQueried < MFCProtocol.NOT_EXISTING_RECHECK_INTERVAL:
+                continue
+            self._query(model, now)
+
+    def _query(self, model, now, attempt=0):
+        METRICS.inc("queries_sent")
+        model.lastQueried = now
+        if model.pendingSince is None:
+            model.pendingSince = now
+        request_id = str(next(self._request_ids))
+        with self._pending_lock:
+            self._pending[request_id] = (model, now, attempt)
+        if LOGGER.is_enabled(Logger.LOG_LEVELS.DEBUG):
+            LOGGER.printline("Send info request "+request_id+" for model "+str(model), log_level=Logger.LOG_LEVELS.DEBUG)
+        self.send("10 "+self.sessionId+" 0 "+request_id+" 0 "+model.name+"\n\0")
+
+# reads its socket from a thread of its own
+class MFCClient(MFCProtocol, WebSocketClient):
+
+    def __init__(self, url, protocols=None):
+        WebSocketClient.__init__(self, url, protocols=protocols)
+        self._initProtocol()
+
+    # the handshake was bounded by the connect timeout, the session is read without one
+    def handshake_ok(self):
+        self.sock.settimeout(None)
+        WebSocketClient.handshake_ok(self)
+
+# read by a WebSocketManager, which polls the sockets of all its clients from a single thread
+class MFCManagedClient(MFCProtocol, WebSocketBaseClient):
+
+    def __init__(self, url, manager, protocols=None):
+        WebSocketBaseClient.__init__(self, url, protocols=protocols)
+        self.manager = manager
+        self._initProtocol()
+
+    def handshake_ok(self):
+        self.sock.settimeout(None)
+        self.manager.add(self)
+
+# runs timed calls, one after the other, in the thread that runs it. Calls can be scheduled from any thread
+class Scheduler:
 
-    def _getJsonPartsFromData(self,data):
-        count=0
-        startIdx=-1
-        result=[]
-        for i, ch in enumerate(data, start=0):
-            if ch == "{":
-                if startIdx == -1:
-                    startIdx=i
-                count += 1
-            elif ch == "}":
-                count -= 1
-                
-            if count <= 0 and startIdx != -1:
-                result.append(data[startIdx:i+1])
-                startIdx=-1
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self.stopped = False
+
+    def schedule(self, delay, fct, *args):
+        with self._condition:
+            entry = [time.time()+delay, next(self._counter), fct, args]
+            heapq.heappush(self._queue, entry)
+            self._condition.notify()
+            return entry
+
+    def cancel(self, entry):
+        if entry is not None:
+            entry[2] = None
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self.stopped:
+                    if self._queue and self._queue[0][0] <= time.time():
+                        break
+                    self._condition.wait(self._queue[0][0]-time.time() if self._queue else None)
+                if self.stopped:
+                    return
+                entry = heapq.heappop(self._queue)
+            if entry[2] is None:
+                continue
+            try:
+                entry[2](*entry[3])
+            except Exception as exc:
+                LOGGER.printline("Error in scheduled call "+str(entry[2])+": "+str(exc), log_level=Logger.LOG_LEVELS.ERROR)
+
+# allows rate calls per second on average, in bursts of at most capacity calls
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self._updated = time.time()
+        self.setRate(rate, capacity)
+        self.tokens = self.capacity
+
+    def setRate(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+
+    def available(self, now):
+        self.tokens = min(self.capacity, self.tokens+(now-self._updated)*self.rate)
+        self._updated = now
+        return int(self.tokens)
+
+    def take(self, now):
+        if self.available(now) < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# decides when each model is queried again. Models whose status changed recently, or that often change at
+# this hour of the day, are queried more often than the checking interval, the ones that have been stable
+# for long less often. Only used from the application thread
+class PollScheduler:
+    # the checking interval is scaled by the time since the last change divided by the horizon, within these bounds
+    STABILITY_HORIZON=3600.0
+    MIN_FACTOR=0.25
+    MAX_FACTOR=8.0
+    MIN_INTERVAL=5.0
+    # changes recorded at the same hour of the day (over the loaded history) before the hour counts as active
+    ACTIVE_HOUR_CHANGES=2
+
+    def __init__(self, models, change_times=()):
+        self.models = models
+        self._queue = []
+        self._counter = itertools.count()
+        self._version = None
+        # per model, number of status changes for every hour of the day
+        self._hours = {}
+        self._counted = {}
+        for model_name, event_time in change_times:
+            self._count(model_name, event_time)
+
+    def __len__(self):
+        return len(self._queue)
+
+    # pops at most limit models whose query is due, the caller reschedules them
+    def due(self, now, limit):
+        self._sync(now)
+        result = []
+        while self._queue and self._queue[0][0] <= now and len(result) < limit:
+            due, seq, model = heapq.heappop(self._queue)
+            # dropped or rescheduled since it was queued
+            if model.nextDue != due or self.models.get(model.name) is not model:
+                continue
+            result.append(model)
         return result
 
+    def schedule(self, model, due):
+        model.nextDue = due
+        heapq.heappush(self._queue, (due, next(self._counter), model))
+
+    def scheduleNext(self, model, now, checking_interval):
+        self.schedule(model, now+self.interval(model, now, checking_interval))
+
+    def interval(self, model, now, checking_interval):
+        if model.notExisting:
+            return MFCProtocol.NOT_EXISTING_RECHECK_INTERVAL
+        factor = 1.0
+        if model.lastChange is not None:
+            self._count(model.name, model.lastChange)
+            factor = min(max((now-model.lastChange)/PollScheduler.STABILITY_HORIZON, PollScheduler.MIN_FACTOR), PollScheduler.MAX_FACTOR)
+        interval = checking_interval*factor
+        hours = self._hours.get(model.name)
+        if hours is not None and hours[time.localtime(now).tm_hour] >= PollScheduler.ACTIVE_HOUR_CHANGES:
+            interval = min(interval, checking_interval)
+        return max(interval, PollScheduler.MIN_INTERVAL)
+
+    def _count(self, model_name, event_time):
+        if self._counted.get(model_name) == event_time:
+            return
+        self._counted[model_name] = event_time
+        self._hours.setdefault(model_name, [0]*24)[time.localtime(event_time).tm_hour] += 1
+
+    # models added since the previous call are due right away
+    def _sync(self, now):
+        snapshot = self.models.snapshot()
+        if self._version == snapshot.version:
+            return
+        self._version = snapshot.version
+        for model in snapshot:
+            if model.nextDue is None:
+                self.schedule(model, now)
+
+class ServerScore:
+    # seconds counted for a measurement a server that was tried does not have: it never logged in or never answered
+    UNMEASURED=10.0
+
+    def __init__(self, server, connect_time=None, login_rtt=None, reply_latency=None, failures=0, backoff_until=0):
+        self.server = server
+        self.connect_time = connect_time
+        self.login_rtt = login_rtt
+        self.reply_latency = reply_latency
+        self.failures = failures
+        self.backoff_until = backoff_until
+
+    def score(self):
+        measurements = (self.connect_time, self.login_rtt, self.reply_latency)
+        # servers never tried are tried first
+        if self.failures == 0 and all(value is None for value in measurements):
+            return 0
+        return sum(value if value is not None else ServerScore.UNMEASURED for value in measurements)
+
+    def __str__(self):
+        string = self.server+": "+", ".join(label+" "+("%.3f" % value if value is not None else "-") for label, value in
+                (("connect", self.connect_time), ("login", self.login_rtt), ("reply", self.reply_latency)))
+        if self.failures:
+            string += ", "+str(self.failures)+" failures"
+        if self.backoff_until > time.time():
+            string += ", backing off for "+str(int(self.backoff_until-time.time()))+" seconds"
+        return string
+
+# keeps the measured latencies of the xchat servers (moving averages) to pick the fastest healthy one,
+# failing servers are not picked again until their exponential backoff has elapsed
+class ServerPool:
+    SMOOTHING=0.3
+    MIN_BACKOFF=5.0
+    MAX_BACKOFF=900.0
+
+    def __init__(self, servers, scores=()):
+        self._scores = OrderedDict((server, ServerScore(server)) for server in servers)
+        for score in scores:
+            if score.server in self._scores:
+                self._scores[score.server] = score
+
+    def choose(self, exclude=()):
+        now = time.time()
+        healthy = [score for score in self._scores.itervalues() if score.backoff_until <= now]
+        if not healthy:
+            return min(self._scores.itervalues(), key=lambda x: x.backoff_until).server
+        candidates = [score for score in healthy if score.server not in exclude] or healthy
+        return min(candidates, key=lambda x: x.score()).server
+
+    def hasHealthy(self):
+        now = time.time()
+        return any(score.backoff_until <= now for score in self._scores.itervalues())
+
+    def recordConnect(self, server, duration):
+        score = self._scores[server]
+        score.connect_time = self._smooth(score.connect_time, duration)
+
+    # a server that accepts connections without logging them in is still failing
+    def recordLogin(self, server, rtt):
+        score = self._scores[server]
+        score.login_rtt = self._smooth(score.login_rtt, rtt)
+        score.failures = 0
+        score.backoff_until = 0
+
+    def recordReplyLatency(self, server, latency):
+        score = self._scores[server]
+        score.reply_latency = self._smooth(score.reply_latency, latency)
+
+    def recordFailure(self, server):
+        score = self._scores[server]
+        score.failures += 1
+        score.backoff_until = time.time()+min(ServerPool.MIN_BACKOFF*2**(score.failures-1), ServerPool.MAX_BACKOFF)
+
+    def scores(self):
+        return self._scores.values()
+
+    def _smooth(self, average, value):
+        if average is None:
+            return value
+        return average+ServerPool.SMOOTHING*(value-average)
+
 class MainApplication(threading.Thread):
 
     WEBSOCKET_SERVERS=[
@@ -220,72 +1541,467 @@ class MainApplication(threading.Thread):
             "xchat12",
             "xchat20"
     ];
-
-    def __init__(self):
+    WEBSOCKET_URL='ws://%s.myfreecams.com:8080/fcsl'
+    MIN_RECONNECT_DELAY=1.0
+    MAX_RECONNECT_DELAY=60.0
+    LOGIN_TIMEOUT=10.0
+    # a session that received nothing for this long while its queries timed out is resumed, its peer may be gone
+    # without closing the connection
+    SILENT_SESSION_TIMEOUT=30.0
+    # connects run on the scheduler thread, a server that does not complete the handshake must not hold it longer
+    CONNECT_TIMEOUT=5.0
+    # a session dropped before it has been logged in for this many seconds counts as a failure of its server,
+    # the delay before resuming the session is only reset by one that stayed logged in longer
+    STABLE_SESSION=60.0
+    # the due model queries are sent at every tick, within the query budget
+    POLL_TICK=1.0
+    # next tick when the sessions could not take all the due queries, the replies free their window meanwhile
+    BACKLOG_TICK=0.05
+    # days of status history used to find the active hours of the models
+    ACTIVITY_DAYS=14
+    # a session that received pushed updates within this many seconds is considered up to date
+    PUSH_ACTIVITY_TIMEOUT=60.0
+
+    ENGINES=enum(
+            THREADED = "threaded",
+            MANAGED = "managed")
+
+    def __init__(self, launched=None):
         threading.Thread.__init__(self)
+        # the first sweep is complete once all the models have been answered
+        self.launched=launched if launched is not None else time.time()
+        self.first_sweep_seconds=None
+        # registry version, index of the first model not answered yet and time of the last reply before it
+        self._first_sweep_progress=(None, 0, None)
         self.db_connector = ApplicationDatabaseConnector(APPLICATION_DATABASE)
-        self.models=map(lambda x: MFCModel(x),self.db_connector.get_models())
+        self.shard_count=self.db_connector.retrieve_default_value("SHARD_COUNT")
+        self.models=MFCModelRegistry(shard_count=self.shard_count)
+        # each distinct name is in the registry once, whatever the number of tenants watching it
+        self.tenants={}
+        watchlists=self.db_connector.get_watchlists()
+        for tenant_id in sorted(set(watchlists) | set(self.db_connector.get_application_ids()) | set([0])):
+            self.models.addAll(watchlists.get(tenant_id, ()), self.getTenant(tenant_id))
         self.checking_interval=self.db_connector.retrieve_default_value("CHECKING_INTERVAL")
         self.initial_dektop_notify_enabled=self.db_connector.retrieve_default_value("DESKTOP_NOTIFICATIONS_INITIAL")
-        self.display_transition_to_offline=self.db_connector.retrieve_default_value("SHOW_TRANSITION_TO_OFFLINE")
-
-        self.ws = None
+        self.engine=self.db_connector.retrieve_default_value("ENGINE")
+        self.server_pool=ServerPool(MainApplication.WEBSOCKET_SERVERS, self.db_connector.get_server_scores())
+        # from here on, all the writes go through the writer thread
+        self.db_writer=DatabaseWriter(APPLICATION_DATABASE)
+        self.db_connector.writer=self.db_writer
+        # statuses saved by the previous run, no need to treat the first sweep as a cold start
+        self.warm_start=self._restoreModelStates(self.db_connector.get_model_states())
+        self.query_budget=self.db_connector.retrieve_default_value("QUERY_BUDGET")
+        self.query_bucket=TokenBucket(self.query_budget)
+        self.reconciliation_interval=self.db_connector.retrieve_default_value("RECONCILIATION_INTERVAL")
+        self.metrics_port=self.db_connector.retrieve_default_value("METRICS_PORT")
+        self.metrics_server=None
+        # served with the metrics
+        self.change_feed=ChangeFeed()
+        change_times=self.db_connector.get_status_changes(time.time()-MainApplication.ACTIVITY_DAYS*86400)
+        for model_name, event_time in change_times:
+            model = self.models.get(model_name)
+            if model is not None:
+                model.lastChange = event_time
+        self.poll_scheduler=PollScheduler(self.models, change_times)
+
+        # all timers (sweeps, heartbeats, reconnects) run from this thread through the scheduler
+        self.scheduler = Scheduler()
+        self.manager = None
+        self.recorder = None
+        # started by the profile command of the console or of any control connection
+        self.profiler = None
+        # one websocket session per shard of the models
+        self.sessions = []
+        self.session_servers = []
+        self.reconnect_delay = []
         self.first =True
         self.stopped=False
+        self.last_sweep=0
+        self._sweep_entry=None
+        self._poll_entry=None
+        # timed out queries, sent again before the due ones
+        self._retries=[]
+
+    # created with the settings stored for it, or the ones of tenant 0 when it has none yet
+    def getTenant(self,tenant_id):
+        tenant = self.tenants.get(tenant_id)
+        if tenant is None:
+            tenant = Tenant(tenant_id,
+                            desktop_notifications=self.db_connector.retrieve_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED", tenant_id),
+                            display_transition_to_offline=self.db_connector.retrieve_default_value("SHOW_TRANSITION_TO_OFFLINE", tenant_id))
+            self.tenants[tenant_id] = tenant
+        return tenant
+
+    def _restoreModelStates(self,states):
+        restored = False
+        for model in self.models:
+            state = states.get(model.name)
+            if state is None:
+                continue
+            model.status, model.isOnline, model.lastSeen, model.lastQueried, model.notExisting = state
+            restored = True
+        return restored
 
     def run(self):
-        while not self.stopped:
+        self.db_writer.start()
+        self.setMetricsPort(self.metrics_port)
+        self.displayModelsToCheck(log_level=Logger.LOG_LEVELS.INFO)
+        self._applyShardCount()
+        self.last_sweep=time.time()
+        self._sweep_entry=self.scheduler.schedule(self.checking_interval, self._sweep)
+        self._poll_entry=self.scheduler.schedule(MainApplication.POLL_TICK, self._poll)
+        self.scheduler.run()
+
+    def setCheckingInterval(self,interval):
+        self.checking_interval=interval
+        self.scheduler.schedule(0, self._rescheduleSweep)
+
+    def setQueryBudget(self,query_budget):
+        self.query_budget=query_budget
+        self.scheduler.schedule(0, self.query_bucket.setRate, query_budget)
+
+    # 0 stops serving the metrics
+    def setMetricsPort(self,port):
+        self.metrics_port=port
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server=None
+        if port > 0:
+            try:
+                self.metrics_server=MetricsServer(port, feed=self.change_feed, snapshot=StatusSnapshot(self.models, self.change_feed))
+            except Exception as exc:
+                LOGGER.printline("Unable to serve the metrics on port "+str(port)+": "+str(exc), log_level=Logger.LOG_LEVELS.ERROR)
+                return
+            self.metrics_server.start()
+            LOGGER.printline("Serving the metrics and the status changes on http://127.0.0.1:"+str(port)+"/", log_level=Logger.LOG_LEVELS.INFO)
+
+    # None stops recording
+    def setRecorder(self,recorder):
+        self.scheduler.schedule(0, self._applyRecorder, recorder)
+
+    def _applyRecorder(self,recorder):
+        previous = self.recorder
+        if recorder is not None:
+            recorder.recordModels(self.models)
+        self.recorder = recorder
+        for ws in self.sessions:
+            if ws is not None:
+                ws.recorder = recorder
+        if previous is not None:
+            previous.close()
+
+    def setShardCount(self,shard_count):
+        self.shard_count=shard_count
+        self.scheduler.schedule(0, self._applyShardCount)
+
+    # called from the thread reading the session
+    def sessionLoggedIn(self,ws):
+        self.scheduler.schedule(0, self._loggedIn, ws)
+
+    # called from the thread reading the session
+    def sessionClosed(self,ws):
+        self.scheduler.schedule(0, self._sessionLost, ws)
+
+    def _loggedIn(self,ws):
+        if ws.shard < len(self.sessions) and self.sessions[ws.shard] is ws:
+            self.server_pool.recordLogin(self.session_servers[ws.shard], ws.login_rtt)
+        self.scheduler.schedule(MFCProtocol.HEARTBEAT_INTERVAL, self._heartbeat, ws)
+        # statuses may have changed while the shard had no session, its models are queried again as soon as the budget allows
+        now = time.time()
+        for model in self.models.shard(ws.shard):
+            if model.notExisting and model.lastQueried is not None:
+                self.poll_scheduler.schedule(model, model.lastQueried+MFCProtocol.NOT_EXISTING_RECHECK_INTERVAL)
+            else:
+                self.poll_scheduler.schedule(model, now)
+        # without waiting for the next tick
+        self._poll()
+
+    def _checkLogin(self,ws):
+        if ws.terminated or ws.isLoggedIn() or ws.shard >= len(self.sessions) or self.sessions[ws.shard] is not ws:
+            return
+        server = self.session_servers[ws.shard]
+        LOGGER.printline("No login reply from "+server+" within "+str(MainApplication.LOGIN_TIMEOUT)+" seconds", log_level=Logger.LOG_LEVELS.WARN)
+        self._dropSession(ws)
+
+    # a server that does not answer does not answer the close frame either. The connection is shut down, its
+    # reading thread then ends on its own, and the session is resumed without waiting for it
+    def _dropSession(self,ws):
+        if ws.sock is not None:
+            try:
+                ws.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._sessionLost(ws)
+
+    def _sweep(self):
+        self.last_sweep=time.time()
+        self._sweep_entry=self.scheduler.schedule(self.checking_interval, self._sweep)
+        self._sweepCompleted()
+        self.db_writer.flush()
+        for shard, ws in enumerate(self.sessions):
+            if ws is not None:
+                latency = ws.takeReplyLatency()
+                if latency is not None:
+                    self.server_pool.recordReplyLatency(self.session_servers[shard], latency)
+
+    # sends the retries and the queries that are due, over the session of their shard
+    def _poll(self):
+        self.scheduler.cancel(self._poll_entry)
+        self._poll_entry = self.scheduler.schedule(MainApplication.POLL_TICK, self._poll)
+        now = time.time()
+        backlog = False
+        for ws in self._loggedInSessions():
+            expired = ws.expireQueries(now-MFCProtocol.QUERY_TIMEOUT)
+            if expired and now-ws.last_received > MainApplication.SILENT_SESSION_TIMEOUT:
+                LOGGER.printline("Nothing received from shard "+str(ws.shard)+" for "+str(int(now-ws.last_received))+" seconds", log_level=Logger.LOG_LEVELS.WARN)
+                # queried again as soon as the new session has logged in
+                for model, sent_at, attempt in expired+ws.expireQueries(now):
+                    model.pendingSince = None
+                self._dropSession(ws)
+                continue
+            for model, sent_at, attempt in expired:
+                self._queryTimedOut(model, sent_at, attempt)
 
-            if self.ws is None:
-                self.displayModelsToCheck(log_level=Logger.LOG_LEVELS.INFO)
+        retries, self._retries = self._retries, []
+        for model, attempt in retries:
+            if model.pendingSince is None:
+                continue
+            if self.models.get(model.name) is model and self._sendQuery(model, now, attempt) is False:
+                self._retries.append((model, attempt))
+
+        models = self.poll_scheduler.due(now, self.query_bucket.available(now))
+        for model in models:
+            # still waiting for the reply to a previous query or its retries
+            if model.pendingSince is not None and now-model.pendingSince < MFCProtocol.QUERY_TIMEOUT*MFCProtocol.MAX_QUERY_ATTEMPTS:
+                self.poll_scheduler.scheduleNext(model, now, self._pollingInterval(model, now))
+                continue
+            sent = self._sendQuery(model, now)
+            if sent:
+                self.poll_scheduler.scheduleNext(model, now, self._pollingInterval(model, now))
+            elif sent is False:
+                # the session is busy, the model keeps its place in the queue
+                self.poll_scheduler.schedule(model, model.nextDue)
+                backlog = True
             else:
-                self.models = self.ws.models
-                self.ws.close()
-                self.displayStatus(log_level=Logger.LOG_LEVELS.DEBUG)
-
-            url = 'ws://'+MainApplication.WEBSOCKET_SERVERS[randint(0,len(MainApplication.WEBSOCKET_SERVERS)-1)]+'.myfreecams.com:8080/fcsl'
-            LOGGER.printline("Connecting to "+url, log_level=Logger.LOG_LEVELS.DEBUG)
-
-            self.ws = MFCClient(url, protocols=['http-only', 'chat'])
-            self.ws.models=self.models
-            if self.first and not self.initial_dektop_notify_enabled:
-                self.ws.desktop_notify_enabled = False
-            self.ws.display_transition_to_offline=self.display_transition_to_offline
-
-            start_connect=time.time()
-            self.ws.connect()
-            self.ws.run_forever()
-            self.ws.desktop_notify_enabled = True
-
-            if self.first:
-                self.ws.check_consistency()
-                self.first=False
-
-            duration_connect=time.time()-start_connect
-            LOGGER.printline("Sleeping "+str(self.checking_interval-duration_connect)+" (start: "+str(start_connect)+" , duration: "+str(duration_connect)+") if not interrupted ("+str(self.stopped)+")", log_level=Logger.LOG_LEVELS.DEBUG)
-            while not self.stopped and duration_connect < self.checking_interval:
-                time.sleep(0.5)
-                duration_connect=time.time()-start_connect
+                # queried again once the session of the shard has logged in
+                self.poll_scheduler.schedule(model, now+self.checking_interval)
+        if models:
+            LOGGER.printline("%d model queries due, %d scheduled", log_level=Logger.LOG_LEVELS.DEBUG, args=(len(models), len(self.poll_scheduler)))
+        if self.first:
+            self._checkFirstSweep()
+        # a budget that ran out does not refill faster
+        if backlog and self.query_bucket.available(now) >= 1:
+            self.scheduler.cancel(self._poll_entry)
+            self._poll_entry = self.scheduler.schedule(MainApplication.BACKLOG_TICK, self._poll)
+
+    # the queries are paced by the budget, the first sweep ends once every model has been answered, however long
+    # it takes. Its duration is measured up to the last of the first replies, not up to the tick that notices it
+    # A model restored as not existing is settled until its recheck is due. The models settled already are not
+    # walked again at the next tick, unless the watchlist changed
+    def _checkFirstSweep(self):
+        now = time.time()
+        snapshot = self.models.snapshot()
+        version, start, last_reply = self._first_sweep_progress
+        if version != snapshot.version:
+            start, last_reply = 0, None
+        ordered = snapshot.ordered
+        for index in xrange(start, len(ordered)):
+            model = ordered[index]
+            if not model.isChecked and not model.noReply:
+                restored = model.notExisting and model.lastQueried is not None and model.lastQueried < self.launched
+                if not restored or now-model.lastQueried >= MFCProtocol.NOT_EXISTING_RECHECK_INTERVAL:
+                    self._first_sweep_progress = (snapshot.version, index, last_reply)
+                    return
+            reply_time = model.lastSeen if model.isChecked and not model.notExisting else model.lastQueried
+            if reply_time is not None and reply_time >= self.launched:
+                last_reply = max(last_reply, reply_time)
+        # the transitions of the first sweep are not notified, the following ones are
+        for ws in self.sessions:
+            if ws is not None:
+                ws.desktop_notify_enabled = True
+        self.first=False
+        if last_reply is None:
+            return
+        self.first_sweep_seconds = last_reply-self.launched
+        METRICS.observe("first_sweep_seconds", self.first_sweep_seconds)
+        LOGGER.printline("First sweep of %d models completed %.3f seconds after launch", log_level=Logger.LOG_LEVELS.INFO, args=(len(self.models), self.first_sweep_seconds))
+
+    # while the session receives pushed updates, polling only catches up with the ones that were missed
+    def _pollingInterval(self, model, now):
+        ws = self._sessionOf(model)
+        if ws is not None and now-ws.last_push < MainApplication.PUSH_ACTIVITY_TIMEOUT:
+            return max(self.reconciliation_interval, self.checking_interval)
+        return self.checking_interval
+
+    def _sessionOf(self, model):
+        shard = self.models.shardOf(model.name)
+        return self.sessions[shard] if shard is not None and shard < len(self.sessions) else None
+
+    # True when sent, False when the query budget or the session does not allow it now, None without session
+    def _sendQuery(self, model, now, attempt=0):
+        ws = self._sessionOf(model)
+        if ws is None or not ws.isLoggedIn():
+            return None
+        if ws.inFlight() >= MFCProtocol.MAX_IN_FLIGHT or not self.query_bucket.take(now):
+            return False
+        ws._query(model, now, attempt)
+        return True
+
+    def _queryTimedOut(self, model, sent_at, attempt):
+        METRICS.inc("query_timeouts")
+        if self.models.get(model.name) is not model:
+            return
+        # answered in the meantime, by the reply to a later attempt or by a pushed update
+        if model.pendingSince is None or (model.lastSeen is not None and model.lastSeen > sent_at):
+            return
+        if attempt+1 < MFCProtocol.MAX_QUERY_ATTEMPTS:
+            self._retries.append((model, attempt+1))
+            return
+        model.pendingSince = None
+        if not model.noReply:
+            model.noReply = True
+            LOGGER.printline("No reply to the last "+str(MFCProtocol.MAX_QUERY_ATTEMPTS)+" queries for model "+model.name, log_level=Logger.LOG_LEVELS.WARN)
+
+    def _rescheduleSweep(self):
+        self.scheduler.cancel(self._sweep_entry)
+        self._sweep_entry=self.scheduler.schedule(max(0, self.last_sweep+self.checking_interval-time.time()), self._sweep)
+
+    def _heartbeat(self,ws):
+        if ws.terminated:
+            return
+        ws._heartbeat()
+        self.scheduler.schedule(MFCProtocol.HEARTBEAT_INTERVAL, self._heartbeat, ws)
+
+    # runs once per session: from closed(), or from _dropSession first, after which the session is replaced
+    def _sessionLost(self,ws):
+        shard=ws.shard
+        if self.stopped or shard >= len(self.sessions) or self.sessions[shard] is not ws:
+            return
+        stable = ws.logged_in_at is not None and time.time()-ws.logged_in_at >= MainApplication.STABLE_SESSION
+        if stable:
+            self.reconnect_delay[shard] = MainApplication.MIN_RECONNECT_DELAY
+        else:
+            self.server_pool.recordFailure(self.session_servers[shard])
+        # sessions dropped one after the other are resumed less and less often
+        delay = self.reconnect_delay[shard]
+        self.reconnect_delay[shard] = min(delay*2, MainApplication.MAX_RECONNECT_DELAY)
+        LOGGER.printline("Connection of shard "+str(shard)+" lost, resuming session in "+str(delay)+" seconds", log_level=Logger.LOG_LEVELS.WARN)
+        self.sessions[shard] = None
+        self.scheduler.schedule(delay, self._connect, shard)
+
+    def _applyShardCount(self):
+        shard_count = self.shard_count
+        if shard_count == len(self.sessions):
+            return
+        LOGGER.printline("Spreading the models over "+str(shard_count)+" sessions", log_level=Logger.LOG_LEVELS.DEBUG)
+        self.models.setShardCount(shard_count)
+        removed = self.sessions[shard_count:]
+        missing = shard_count-len(self.sessions)
+        self.sessions = self.sessions[:shard_count]+[None]*missing
+        self.session_servers = self.session_servers[:shard_count]+[None]*missing
+        self.reconnect_delay = self.reconnect_delay[:shard_count]+[MainApplication.MIN_RECONNECT_DELAY]*missing
+        for ws in removed:
+            if ws is not None:
+                ws.close()
+        for shard in range(shard_count-missing, shard_count):
+            self._connect(shard)
+
+    def _connect(self,shard):
+        if self.stopped or shard >= len(self.sessions) or self.sessions[shard] is not None:
+            return
+        # prefer a server that is not yet used by the sessions of the other shards
+        server = self.server_pool.choose(exclude=self.session_servers)
+        url = MainApplication.WEBSOCKET_URL % server
+        LOGGER.printline("Connecting shard "+str(shard)+" to "+url, log_level=Logger.LOG_LEVELS.DEBUG)
+
+        if self.engine == MainApplication.ENGINES.MANAGED:
+            if self.manager is None:
+                self.manager = WebSocketManager()
+                self.manager.daemon = True
+                self.manager.start()
+            ws = MFCManagedClient(url, self.manager, protocols=['http-only', 'chat'])
+        else:
+            ws = MFCClient(url, protocols=['http-only', 'chat'])
+        ws.models=self.models
+        ws.shard=shard
+        if self.first and not self.warm_start and not self.initial_dektop_notify_enabled:
+            ws.desktop_notify_enabled = False
+        ws.status_history=self.db_writer
+        ws.change_feed=self.change_feed
+        ws.recorder=self.recorder
+        ws.listener=self
+
+        start_connect=time.time()
+        try:
+            ws.sock.settimeout(MainApplication.CONNECT_TIMEOUT)
+            ws.connect()
+        except Exception as exc:
+            LOGGER.printline("Unable to connect to "+url+": "+str(exc), log_level=Logger.LOG_LEVELS.ERROR)
+            ws.listener=None
+            ws.terminate()
+            self.server_pool.recordFailure(server)
+            METRICS.inc("connect_failures")
+            # another server is tried right away, only back off when all of them are failing
+            if self.server_pool.hasHealthy():
+                delay = MainApplication.MIN_RECONNECT_DELAY
+            else:
+                delay = self.reconnect_delay[shard]
+                self.reconnect_delay[shard] = min(delay*2, MainApplication.MAX_RECONNECT_DELAY)
+            self.scheduler.schedule(delay, self._connect, shard)
+            return
+        duration_connect=time.time()-start_connect
+        METRICS.observe("connect_seconds", duration_connect)
+        self.sessions[shard] = ws
+        self.session_servers[shard] = server
+        self.server_pool.recordConnect(server, duration_connect)
+        self.scheduler.schedule(MainApplication.LOGIN_TIMEOUT, self._checkLogin, ws)
+        LOGGER.printline("Connected in "+str(duration_connect), log_level=Logger.LOG_LEVELS.DEBUG)
+
+    def _loggedInSessions(self):
+        return [ws for ws in self.sessions if ws is not None and ws.isLoggedIn()]
+
+    def _sweepCompleted(self):
+        self.displayStatus(log_level=Logger.LOG_LEVELS.DEBUG)
 
     def stopApplication(self): 
-        if self.ws is not None:
-            self.ws.close()
+        self.stopped=True
+        self.scheduler.stop()
+        for ws in self.sessions:
+            if ws is not None:
+                # the reading threads may still be running while the interpreter exits
+                ws.listener = None
+                ws.close()
+        if self.manager is not None:
+            self.manager.stop()
+        self.db_writer.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         if self.db_connector is not None:
+            # the writer has stopped, these are committed right away
+            self.db_connector.writer = None
+            self.db_connector.save_server_scores(self.server_pool.scores())
+            self.db_connector.save_model_states(self.models)
             self.db_connector.close()
-        self.stopped=True
 
-    def recheckConsistency(self):
-        self.ws.check_consistency()
+    # the models of all the tenants without tenant, online and offline ones taken from the same snapshot
+    def displayStatus(self,log_level=Logger.LOG_LEVELS.INFO,tenant=None):
+        if not LOGGER.is_enabled(log_level):
+            return
+        label = tenant.label if tenant is not None else str
+        models = self.models.watchedBy(tenant) if tenant is not None else list(self.models)
+        LOGGER.printline("All online models: "+", ".join(label(model) for model in models if model.isOnline), log_level=log_level)
+        LOGGER.printline("All offline models: "+", ".join(label(model) for model in models if not model.isOnline), log_level=log_level)
 
-    def displayStatus(self,log_level=Logger.LOG_LEVELS.INFO):
-        LOGGER.printline("All online models: "+", ".join(map(str,filter(lambda x: x.isOnline,self.models))), log_level=log_level)
-        LOGGER.printline("All offline models: "+", ".join(map(str,filter(lambda x: not x.isOnline,self.models))), log_level=log_level)
+    def displayServers(self,log_level=Logger.LOG_LEVELS.INFO):
+        LOGGER.printline("Servers (connect time, login round-trip and reply latency in seconds):\n    "+"\n    ".join(map(str,self.server_pool.scores())), log_level=log_level)
 
     def displayModelsToCheck(self,log_level=Logger.LOG_LEVELS.INFO):
         LOGGER.printline("All models to check: "+", ".join(map(str,self.models)), log_level=log_level)
 
     def getModel(self,model_name):
-        return self.ws.getModel(model_name)
+        return self.models.get(model_name)
 
 class UserCommandProcessor:
 
@@ -347,6 +2063,8 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
     def __init__(self,app):
         UserCommandProcessor.__init__(self)
         self.app = app 
+        # the watchlist, mute and notification commands apply to this tenant
+        self.tenant = app.getTenant(0)
 
     def _configureCommands(self):
         self.USER_COMMANDS_LABELS.STOP = "STOP"
@@ -357,12 +2075,27 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
         self.USER_COMMANDS_LABELS.NONOTIFY_INITIAL = "NONOTIFY_INITIAL"
         self.USER_COMMANDS_LABELS.NOTIFY = "NOTIFY"
         self.USER_COMMANDS_LABELS.NOTIFY_INITIAL = "NOTIFY_INITIAL"
+        self.USER_COMMANDS_LABELS.NOTIFY_WINDOW = "NOTIFY_WINDOW"
         self.USER_COMMANDS_LABELS.LOGLEVEL = "LOGLEVEL"
         self.USER_COMMANDS_LABELS.INTERVAL = "INTERVAL"
         self.USER_COMMANDS_LABELS.SHOWCONFIG = "SHOWCONFIG"
         self.USER_COMMANDS_LABELS.MUTE = "MUTE"
         self.USER_COMMANDS_LABELS.UNMUTE = "UNMUTE"
         self.USER_COMMANDS_LABELS.TRANSITION = "TRANSITION"
+        self.USER_COMMANDS_LABELS.SHARDS = "SHARDS"
+        self.USER_COMMANDS_LABELS.ENGINE = "ENGINE"
+        self.USER_COMMANDS_LABELS.SERVERS = "SERVERS"
+        self.USER_COMMANDS_LABELS.HISTORY = "HISTORY"
+        self.USER_COMMANDS_LABELS.UPTIME = "UPTIME"
+        self.USER_COMMANDS_LABELS.BUDGET = "BUDGET"
+        self.USER_COMMANDS_LABELS.RECONCILE = "RECONCILE"
+        self.USER_COMMANDS_LABELS.RECORD = "RECORD"
+        self.USER_COMMANDS_LABELS.STATS = "STATS"
+        self.USER_COMMANDS_LABELS.METRICS = "METRICS"
+        self.USER_COMMANDS_LABELS.PROFILE = "PROFILE"
+        self.USER_COMMANDS_LABELS.IMPORT = "IMPORT"
+        self.USER_COMMANDS_LABELS.EXPORT = "EXPORT"
+        self.USER_COMMANDS_LABELS.TENANT = "TENANT"
         self._addCommands({
             self.USER_COMMANDS_LABELS.STOP: {
                 "description": "Stop the program",
@@ -388,6 +2121,9 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
             self.USER_COMMANDS_LABELS.NOTIFY_INITIAL: {
                 "description": "Turn on desktop notifications on the first check. De-activate them with the command "+self.USER_COMMANDS_LABELS.NONOTIFY_INITIAL.lower(),
                 "fct": "_execute_notify_initial" },
+            self.USER_COMMANDS_LABELS.NOTIFY_WINDOW: {
+                "description": "Combine the desktop notifications of the same kind sent within this window into a single one. Argument: window (in seconds)",
+                "fct": "_execute_notify_window" },
             self.USER_COMMANDS_LABELS.LOGLEVEL: {
                 "description": "Temporarily change the amount of logging. Argument: logging level (TRACE, DEBUG, INFO, WARN, ERROR, FATAL)",
                 "fct": "_execute_loglevel" },
@@ -395,7 +2131,7 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
                 "description": "List the available user commands",
                 "fct": "_execute_list" },
             self.USER_COMMANDS_LABELS.INTERVAL: {
-                "description": "Adjust the checking interval. Don't put it lower than 20 seconds or the system will collapse. Argument: interval (in seconds)",
+                "description": "Adjust the checking interval. Models that changed status recently are checked more often, the ones that have been stable for long less often. Argument: interval (in seconds)",
                 "fct": "_execute_interval" },
             self.USER_COMMANDS_LABELS.SHOWCONFIG: {
                 "description": "Show the application configuration",
@@ -408,45 +2144,130 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
                 "fct": "_execute_unmute" },
             self.USER_COMMANDS_LABELS.TRANSITION: {
                 "description": "Indicate which transitions in model state should be shown. Supported commands:\n                     * "+self.USER_COMMANDS_LABELS.TRANSITION.lower()+" offline true\n                     * "+self.USER_COMMANDS_LABELS.TRANSITION.lower()+" offline false",
-                "fct": "_execute_transition" }
+                "fct": "_execute_transition" },
+            self.USER_COMMANDS_LABELS.SHARDS: {
+                "description": "Spread the models over this number of sessions on different servers, checked in parallel. Argument: number of sessions",
+                "fct": "_execute_shards" },
+            self.USER_COMMANDS_LABELS.ENGINE: {
+                "description": "Choose how the sessions are read, used for the next connections. Argument: "+MainApplication.ENGINES.THREADED+" (one thread per session) or "+MainApplication.ENGINES.MANAGED+" (all sessions polled from a single thread)",
+                "fct": "_execute_engine" },
+            self.USER_COMMANDS_LABELS.SERVERS: {
+                "description": "Show the measured latencies and failures of the servers",
+                "fct": "_execute_servers" },
+            self.USER_COMMANDS_LABELS.HISTORY: {
+                "description": "Show the status changes of a model. Arguments: model name, optionally the number of days (default 1)",
+                "fct": "_execute_history" },
+            self.USER_COMMANDS_LABELS.UPTIME: {
+                "description": "Show how long a model has been online. Arguments: model name, optionally the number of days (default 7)",
+                "fct": "_execute_uptime" },
+            self.USER_COMMANDS_LABELS.BUDGET: {
+                "description": "Limit the number of model queries sent per second, over all sessions. Argument: queries per second",
+                "fct": "_execute_budget" },
+            self.USER_COMMANDS_LABELS.RECONCILE: {
+                "description": "Adjust the checking interval used while the server pushes the status changes itself. Argument: interval (in seconds)",
+                "fct": "_execute_reconcile" },
+            self.USER_COMMANDS_LABELS.RECORD: {
+                "description": "Append the frames sent and received by the sessions to a file, to be replayed with MFCreplay.py. Argument: file name, or off to stop recording",
+                "fct": "_execute_record" },
+            self.USER_COMMANDS_LABELS.STATS: {
+                "description": "Show the counters and latencies (in seconds) measured since the start",
+                "fct": "_execute_stats" },
+            self.USER_COMMANDS_LABELS.METRICS: {
+                "description": "Serve the counters and latencies in the prometheus text format on http://127.0.0.1:<port>/metrics, the status changes on /changes?since=<seq> (long poll) and /events (server-sent events) and the state of all the models on /snapshot. Argument: port, or off",
+                "fct": "_execute_metrics" },
+            self.USER_COMMANDS_LABELS.PROFILE: {
+                "description": "Sample where the threads spend their time, the result is shown when turned off. Argument: on or off",
+                "fct": "_execute_profile" },
+            self.USER_COMMANDS_LABELS.IMPORT: {
+                "description": "Add the models listed in a file, one name per line or in the first column of a csv file. Argument: file name",
+                "fct": "_execute_import" },
+            self.USER_COMMANDS_LABELS.EXPORT: {
+                "description": "Write the models to check to a file, with their status when the file name ends with .csv. Argument: file name",
+                "fct": "_execute_export" },
+            self.USER_COMMANDS_LABELS.TENANT: {
+                "description": "Choose the tenant the watchlist, mute and notification commands apply to, created when first used. Without argument, list the tenants. Argument: tenant number",
+                "fct": "_execute_tenant" }
             })
 
     def _execute_stop(self):
         raise KeyboardInterrupt
 
     def _execute_who(self):
-        self.app.displayStatus(log_level=Logger.LOG_LEVELS.FORCE)
+        self.app.displayStatus(log_level=Logger.LOG_LEVELS.FORCE, tenant=self.tenant)
 
     def _execute_add(self,model_names,persist=True):
         if not self._check_input_model_names(model_names):
             return
 
         for model_name in model_names:
-            model = self.app.getModel(model_name)
-            if model:
+            if model_name in self.tenant.models:
                 LOGGER.printline("Model already in list of models that is checked",log_level=Logger.LOG_LEVELS.WARN)
                 continue
     
-            self.app.models.append(MFCModel(model_name))
+            # already queried when another tenant watches it
+            self.app.models.addAll([model_name], self.tenant)
             if persist:
-                self.app.db_connector.add_model(model_name)
+                self.app.db_connector.add_model(model_name, self.tenant.id)
             LOGGER.printline("Model "+model_name+" added",log_level=Logger.LOG_LEVELS.FORCE)
 
-        #threading.Timer(self.app.checking_interval+1, self.app.recheckConsistency).start()
+    def _execute_import(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing file name",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        model_names = []
+        try:
+            with open(arguments[0], "rb") as model_file:
+                for row in csv.reader(model_file):
+                    if not row or row[0].strip().startswith("#"):
+                        continue
+                    model_name = row[0].strip()
+                    if model_name != "" and model_name.lower() not in ("name", "model_name") and " " not in model_name:
+                        model_names.append(model_name)
+        except IOError as exc:
+            LOGGER.printline("Unable to read "+arguments[0]+": "+str(exc),log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        # the registry skips the names the tenant already watches, or listed twice in the file
+        added = self.app.models.addAll(model_names, self.tenant)
+        if added:
+            self.app.db_connector.add_models([model.name for model in added], self.tenant.id)
+        LOGGER.printline(str(len(added))+" models added, "+str(len(model_names)-len(added))+" already in the list",log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_export(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing file name",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        models = self.app.models.watchedBy(self.tenant)
+        try:
+            with open(arguments[0], "wb") as model_file:
+                if arguments[0].lower().endswith(".csv"):
+                    writer = csv.writer(model_file)
+                    writer.writerow(["model_name", "status", "online", "muted", "last_seen"])
+                    for model in models:
+                        writer.writerow([model.name, MFCProtocol.status_label(model.status) if model.status is not None else "",
+                                         "Y" if model.isOnline else "N", "Y" if model.name in self.tenant.muted else "N",
+                                         datetime.datetime.fromtimestamp(model.lastSeen).strftime('%Y-%m-%d %H:%M:%S') if model.lastSeen is not None else ""])
+                else:
+                    model_file.write("".join(model.name+"\n" for model in models))
+        except IOError as exc:
+            LOGGER.printline("Unable to write "+arguments[0]+": "+str(exc),log_level=Logger.LOG_LEVELS.ERROR)
+            return
+        LOGGER.printline(str(len(models))+" models written to "+arguments[0],log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_remove(self,model_names,persist=True):
         if not self._check_input_model_names(model_names):
             return
 
         for model_name in model_names:
-            model = self.app.getModel(model_name)
-            if not model:
+            if model_name not in self.tenant.models:
                 LOGGER.printline("Model not yet in the list of models that is checked",log_level=Logger.LOG_LEVELS.WARN)
                 continue
 
-            self.app.models.remove(model)
+            self.app.models.remove(model_name, self.tenant)
             if persist:
-                self.app.db_connector.remove_model(model_name)
+                self.app.db_connector.remove_model(model_name, self.tenant.id)
             LOGGER.printline("Model "+model_name+" removed",log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_unmute(self,model_names):
@@ -454,10 +2275,9 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
             return
 
         for model_name in model_names:
-            model = self.app.getModel(model_name)
-            if model:
-                if model.isMuted:
-                   model.isMuted = False
+            if model_name in self.tenant.models:
+                if model_name in self.tenant.muted:
+                   self.app.models.unmute(model_name, self.tenant)
                    LOGGER.printline("Model unmuted.",log_level=Logger.LOG_LEVELS.FORCE)
                 else:
                    LOGGER.printline("Model is already unmuted.",log_level=Logger.LOG_LEVELS.WARN)
@@ -469,10 +2289,9 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
             return
 
         for model_name in model_names:
-            model = self.app.getModel(model_name)
-            if model:
-                if not model.isMuted:
-                   model.isMuted = True
+            if model_name in self.tenant.models:
+                if model_name not in self.tenant.muted:
+                   self.app.models.mute(model_name, self.tenant)
                    LOGGER.printline("Model muted.",log_level=Logger.LOG_LEVELS.FORCE)
                 else:
                    LOGGER.printline("Model is already muted.",log_level=Logger.LOG_LEVELS.WARN)
@@ -480,8 +2299,8 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
                 LOGGER.printline("Can not mute a model that is not yet in the list of checked models.",log_level=Logger.LOG_LEVELS.ERROR)
 
     def _execute_nonotify(self):
-        LOGGER.desktop_notifications_activated=False
-        self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED","N")
+        self.tenant.desktop_notifications=False
+        self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED","N",self.tenant.id)
         LOGGER.printline("Desktop notifications disabled",log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_nonotify_initial(self):
@@ -490,8 +2309,8 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
         LOGGER.printline("Initial desktop notifications disabled",log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_notify(self):
-        LOGGER.desktop_notifications_activated=True
-        self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED","Y")
+        self.tenant.desktop_notifications=True
+        self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED","Y",self.tenant.id)
         LOGGER.printline("Desktop notifications enabled",log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_notify_initial(self):
@@ -499,6 +2318,22 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
         self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_INITIAL","Y")
         LOGGER.printline("Initial desktop notifications enabled",log_level=Logger.LOG_LEVELS.FORCE)
 
+    def _execute_notify_window(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing notification window",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        try:
+            window = float(arguments[0])
+        except ValueError:
+            LOGGER.printline("Given notification window does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        if LOGGER.notifier is not None:
+            LOGGER.notifier.window=window
+        self.app.db_connector.update_default_value("DESKTOP_NOTIFICATIONS_WINDOW",window)
+        LOGGER.printline("Notification window set to "+str(window),log_level=Logger.LOG_LEVELS.FORCE)
+
     def _execute_loglevel(self,arguments):
         if not arguments and not len(arguments) == 1:
             LOGGER.printline("Unknown log level "+arguments,log_level=Logger.LOG_LEVELS.ERROR)
@@ -524,10 +2359,179 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
             LOGGER.printline("Given interval does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
             return
 
-        self.app.checking_interval=interval
+        self.app.setCheckingInterval(interval)
         self.app.db_connector.update_default_value("CHECKING_INTERVAL",interval)
         LOGGER.printline("Interval set to "+str(interval),log_level=Logger.LOG_LEVELS.FORCE)
     
+    def _execute_shards(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing number of sessions",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        try:
+            shard_count = int(arguments[0])
+        except ValueError:
+            shard_count = 0
+        if shard_count < 1:
+            LOGGER.printline("Given number of sessions does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        self.app.setShardCount(shard_count)
+        self.app.db_connector.update_default_value("SHARD_COUNT",shard_count)
+        LOGGER.printline("Number of sessions set to "+str(shard_count),log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_budget(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing number of queries per second",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        try:
+            query_budget = float(arguments[0])
+        except ValueError:
+            query_budget = 0
+        if query_budget <= 0:
+            LOGGER.printline("Given number of queries per second does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        self.app.setQueryBudget(query_budget)
+        self.app.db_connector.update_default_value("QUERY_BUDGET",query_budget)
+        LOGGER.printline("Query budget set to "+str(query_budget)+" per second",log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_reconcile(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing interval",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        try:
+            interval = float(arguments[0])
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            LOGGER.printline("Given interval does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        self.app.reconciliation_interval=interval
+        self.app.db_connector.update_default_value("RECONCILIATION_INTERVAL",interval)
+        LOGGER.printline("Reconciliation interval set to "+str(interval),log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_record(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing file name",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        if arguments[0].lower() == "off":
+            self.app.setRecorder(None)
+            LOGGER.printline("Recording stopped",log_level=Logger.LOG_LEVELS.FORCE)
+            return
+
+        try:
+            recorder = FrameRecorder(arguments[0])
+        except IOError as exc:
+            LOGGER.printline("Unable to record to "+arguments[0]+": "+str(exc),log_level=Logger.LOG_LEVELS.ERROR)
+            return
+        self.app.setRecorder(recorder)
+        LOGGER.printline("Recording the frames to "+arguments[0],log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_stats(self):
+        LOGGER.printline("\n    "+"\n    ".join(METRICS.summary()),log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_metrics(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing port",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        if arguments[0].lower() == "off":
+            port = 0
+        else:
+            try:
+                port = int(arguments[0])
+            except ValueError:
+                port = -1
+            if port <= 0 or port > 65535:
+                LOGGER.printline("Given port does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+                return
+
+        self.app.setMetricsPort(port)
+        self.app.db_connector.update_default_value("METRICS_PORT",port)
+        if port == 0:
+            LOGGER.printline("No longer serving the metrics",log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_profile(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing on or off",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        switch = arguments[0].lower()
+        if switch == "on":
+            if self.app.profiler is not None:
+                LOGGER.printline("Already profiling",log_level=Logger.LOG_LEVELS.FORCE)
+                return
+            self.app.profiler = SamplingProfiler()
+            self.app.profiler.start()
+            LOGGER.printline("Profiling started",log_level=Logger.LOG_LEVELS.FORCE)
+        elif switch == "off":
+            profiler = self.app.profiler
+            if profiler is None:
+                LOGGER.printline("Not profiling",log_level=Logger.LOG_LEVELS.FORCE)
+                return
+            self.app.profiler = None
+            profiler.stop()
+            LOGGER.printline("\n    "+"\n    ".join(profiler.report()),log_level=Logger.LOG_LEVELS.FORCE)
+        else:
+            LOGGER.printline("Unknown argument "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+
+    def _execute_history(self,arguments):
+        if not self._check_input_model_names(arguments):
+            return
+        days = self._get_days(arguments, 1)
+        if days is None:
+            return
+
+        events = self.app.db_connector.get_status_history(arguments[0], since=time.time()-days*86400)
+        text = ""
+        for status, event_time in events:
+            text += "\n    "+datetime.datetime.fromtimestamp(event_time).strftime('%Y-%m-%d %H:%M:%S')+"  "+MFCProtocol.status_label(status)
+        LOGGER.printline("Status changes of "+arguments[0]+" in the last "+str(days)+" day(s):"+(text if text else " none"),log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_uptime(self,arguments):
+        if not self._check_input_model_names(arguments):
+            return
+        days = self._get_days(arguments, 7)
+        if days is None:
+            return
+
+        uptime = self.app.db_connector.get_uptime(arguments[0], since=time.time()-days*86400)
+        LOGGER.printline(arguments[0]+" was online "+str(datetime.timedelta(seconds=int(uptime)))+" in the last "+str(days)+" day(s) ("+("%.1f" % (100*uptime/(days*86400)))+"%)",log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _get_days(self, arguments, default):
+        if len(arguments) < 2:
+            return default
+        try:
+            days = float(arguments[1])
+        except ValueError:
+            days = 0
+        if days <= 0:
+            LOGGER.printline("Given number of days does not seem valid "+arguments[1],log_level=Logger.LOG_LEVELS.ERROR)
+            return None
+        return days
+
+    def _execute_servers(self):
+        self.app.displayServers(log_level=Logger.LOG_LEVELS.FORCE)
+
+    def _execute_engine(self,arguments):
+        if not arguments and not len(arguments) == 1:
+            LOGGER.printline("Missing engine",log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        engine = arguments[0].lower()
+        if engine not in (MainApplication.ENGINES.THREADED, MainApplication.ENGINES.MANAGED):
+            LOGGER.printline("Unknown engine "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        self.app.engine=engine
+        self.app.db_connector.update_default_value("ENGINE",engine)
+        LOGGER.printline("Engine set to "+engine+", used for the next connections",log_level=Logger.LOG_LEVELS.FORCE)
+
     def _execute_showconfig(self):
         log_level_label = Logger.log_level_label(LOGGER.log_level)
         if log_level_label != "":
@@ -535,12 +2539,19 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
         else:
             log_level_label = str(LOGGER.log_level)
 
-        LOGGER.printline("\n    All models to check:\n        "+"\n        ".join(map(str,self.app.models))
+        LOGGER.printline("\n    Tenant: "+str(self.tenant.id)+" (of "+str(len(self.app.tenants))+")"
+                        +"\n    All models to check:\n        "+"\n        ".join(map(self.tenant.label,self.app.models.watchedBy(self.tenant)))
                         +"\n    Interval is set to "+str(self.app.checking_interval)
-                        +"\n    Desktop notifications enabled: "+str(LOGGER.desktop_notifications_activated)
+                        +"\n    Reconciliation interval (with pushed updates): "+str(self.app.reconciliation_interval)
+                        +"\n    Query budget (per second): "+str(self.app.query_budget)
+                        +"\n    Number of sessions: "+str(self.app.shard_count)
+                        +"\n    Engine: "+self.app.engine
+                        +"\n    Metrics port: "+(str(self.app.metrics_port) if self.app.metrics_port > 0 else "none")
+                        +"\n    Desktop notifications enabled: "+str(self.tenant.desktop_notifications)
                         +"\n    Inital desktop notifications enabled: "+str(self.app.initial_dektop_notify_enabled)
+                        +"\n    Desktop notification window: "+(str(LOGGER.notifier.window) if LOGGER.notifier is not None else "none")
                         +"\n    Log level is set to "+log_level_label
-                        +"\n    Show transition to offline: "+str(self.app.display_transition_to_offline),log_level=Logger.LOG_LEVELS.FORCE)
+                        +"\n    Show transition to offline: "+str(self.tenant.display_transition_to_offline),log_level=Logger.LOG_LEVELS.FORCE)
 
     def _execute_transition(self,arguments):
         if not arguments and not len(arguments) == 2:
@@ -550,121 +2561,468 @@ class MFCcheckerUserCommandProcessor(UserCommandProcessor):
         transition_type = arguments[0].lower()
         if transition_type == "offline":
             to_value = eval(arguments[1].title())
-            if to_value == self.app.display_transition_to_offline:
+            if to_value == self.tenant.display_transition_to_offline:
                 LOGGER.printline("Already configured like this. Configuration not updated.",log_level=Logger.LOG_LEVELS.FORCE)
                 return
-            self.app.display_transition_to_offline = to_value
-            self.app.db_connector.update_default_value("SHOW_TRANSITION_TO_OFFLINE", "Y" if to_value else "N")
+            self.tenant.display_transition_to_offline = to_value
+            self.app.db_connector.update_default_value("SHOW_TRANSITION_TO_OFFLINE", "Y" if to_value else "N", self.tenant.id)
             LOGGER.printline("Now"+(" no longer" if not to_value else "")+" showing the transition to offline",log_level=Logger.LOG_LEVELS.FORCE)
         else:
             LOGGER.printline("Invalid command structure",log_level=Logger.LOG_LEVELS.ERROR)
 
+    def _execute_tenant(self,arguments=None):
+        if not arguments:
+            LOGGER.printline("Tenants:\n    "+"\n    ".join(
+                    str(tenant)+": "+str(len(tenant.models))+" models, "+str(len(tenant.muted))+" muted"+(" (current)" if tenant is self.tenant else "")
+                    for tenant_id, tenant in sorted(self.app.tenants.iteritems())),log_level=Logger.LOG_LEVELS.FORCE)
+            return
+
+        try:
+            tenant_id = int(arguments[0])
+            if tenant_id < 0:
+                raise ValueError()
+        except ValueError:
+            LOGGER.printline("Given tenant does not seem valid "+arguments[0],log_level=Logger.LOG_LEVELS.ERROR)
+            return
+
+        self.tenant = self.app.getTenant(tenant_id)
+        LOGGER.printline("Commands now apply to "+str(self.tenant)+", watching "+str(len(self.tenant.models))+" models",log_level=Logger.LOG_LEVELS.FORCE)
+
     def _check_input_model_names(self, model_names):
         if not model_names or not len(model_names) > 0 or model_names[0].rstrip() == "":
             LOGGER.printline("Missing model name",log_level=Logger.LOG_LEVELS.ERROR)
             return False
         return True
 
+# the command line of the daemon: the user commands are read from the connections to a unix socket, one per line,
+# and each one is answered with the lines it logged. The connections are served one after the other by the
+# thread calling serve, the same one that owns the database connection of the application
+class ControlSocket:
+    CLIENT_TIMEOUT=30.0
+    ACCEPT_TIMEOUT=1.0
+
+    def __init__(self, socket_path, app):
+        self.socket_path = socket_path
+        self.app = app
+        # left behind by a daemon that did not stop cleanly, unless it is not a socket or a daemon still listens on it
+        if path.exists(socket_path):
+            if not S_ISSOCK(stat(socket_path).st_mode):
+                raise ValueError(socket_path+" exists and is not a socket")
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                unlink(socket_path)
+            else:
+                raise ValueError("another daemon is listening on "+socket_path)
+            finally:
+                probe.close()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(socket_path)
+        self._socket.listen(5)
+        # so that serve notices when the application stops
+        self._socket.settimeout(ControlSocket.ACCEPT_TIMEOUT)
+
+    # until the application stops, or a stop command raises KeyboardInterrupt
+    def serve(self):
+        while self.app.isAlive():
+            try:
+                connection, address = self._socket.accept()
+            except socket.timeout:
+                continue
+            try:
+                self._serve(connection)
+            finally:
+                connection.close()
+
+    def _serve(self, connection):
+        connection.settimeout(ControlSocket.CLIENT_TIMEOUT)
+        reader = connection.makefile("rb")
+        writer = connection.makefile("wb", 0)
+        # each connection chooses its own tenant
+        processor = MFCcheckerUserCommandProcessor(self.app)
+        try:
+            while True:
+                command = reader.readline()
+                if not command:
+                    break
+                LOGGER.capture(writer)
+                try:
+                    processor.execute(command.strip())
+                except Exception as exc:
+                    LOGGER.printline('Error: '+str(exc),log_level=Logger.LOG_LEVELS.ERROR)
+                finally:
+                    LOGGER.capture(None)
+        except socket.error as exc:
+            LOGGER.printline("Control connection closed: "+str(exc),log_level=Logger.LOG_LEVELS.DEBUG)
+
+    def close(self):
+        self._socket.close()
+        if path.exists(self.socket_path):
+            unlink(self.socket_path)
+
+    # sends the commands to the daemon and writes its answers to out
+    @staticmethod
+    def send(socket_path, commands, out):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+        try:
+            client.sendall("".join(command.rstrip("\n")+"\n" for command in commands))
+            client.shutdown(socket.SHUT_WR)
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                out.write(data)
+        finally:
+            client.close()
+
 class ApplicationDatabaseConnector:
     TABLE_DEFAULTS = "application_defaults"
     TABLE_MODELS = "models"
+    TABLE_SERVER_SCORES = "server_scores"
+    TABLE_STATUS_EVENTS = "status_events"
+    TABLE_MODEL_STATES = "model_states"
+    # settings introduced after the initial database, created with their default value when missing
+    DEFAULT_VALUES = [
+            ("DESKTOP_NOTIFICATIONS_WINDOW", "2.0", "str_to_double"),
+            ("SHARD_COUNT", "1", "str_to_int"),
+            ("ENGINE", "threaded", ""),
+            ("QUERY_BUDGET", "20.0", "str_to_double"),
+            ("RECONCILIATION_INTERVAL", "600.0", "str_to_double"),
+            ("METRICS_PORT", "0", "str_to_int")
+            ]
 
     def __init__(self, db_name, application_id = 0):
         self.application_id = application_id
         self.connection = sqlite3.connect(db_name) 
+        self._create_tables()
+        self._create_default_values()
+        self._load_default_values()
+        # when set, the updates are queued to the DatabaseWriter instead of being committed right away
+        self.writer = None
+
+    # tables introduced after the initial database
+    def _create_tables(self):
+        cursor = self.connection.cursor()
+        cursor.execute("create table if not exists "+ApplicationDatabaseConnector.TABLE_SERVER_SCORES+" (server varchar(35) primary key, connect_time real, login_rtt real, reply_latency real, failures int not null, backoff_until real not null)")
+        cursor.execute("create table if not exists "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+" (model_name varchar2(100) not null, status int not null, event_time real not null)")
+        cursor.execute("create index if not exists status_events_index_1 on "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+"(model_name,event_time)")
+        cursor.execute("create table if not exists "+ApplicationDatabaseConnector.TABLE_MODEL_STATES+" (model_name varchar2(100) primary key, status int, is_online varchar(1) not null, last_seen real, last_queried real, not_existing varchar(1) not null)")
+        # the models of the initial database all belong to application 0, a name can be in several watchlists
+        if "application_id" not in [column[1] for column in cursor.execute("pragma table_info("+ApplicationDatabaseConnector.TABLE_MODELS+")")]:
+            cursor.execute("alter table "+ApplicationDatabaseConnector.TABLE_MODELS+" add column application_id int not null default 0")
+            cursor.execute("drop index if exists models_index_2")
+        cursor.execute("create unique index if not exists models_index_3 on "+ApplicationDatabaseConnector.TABLE_MODELS+"(application_id,model_name,to_check)")
+        self.connection.commit()
+
+    def _create_default_values(self):
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("insert or ignore into "+ApplicationDatabaseConnector.TABLE_DEFAULTS+" (application_id,name,value,conversion_function) values (?,?,?,?)",
+                    [(self.application_id,name,value,conversion_function) for name, value, conversion_function in ApplicationDatabaseConnector.DEFAULT_VALUES])
+            self.connection.commit()
+        except Exception as exc:
+            self.connection.rollback()
+            raise exc
 
     def close(self):
         self.connection.close()
 
-    def get_models(self):
+    def get_models(self,application_id=None):
+        return self.get_watchlists().get(self.application_id if application_id is None else application_id, [])
+
+    # the names to check of all the applications, by application_id
+    def get_watchlists(self):
+        cursor = self.connection.cursor()
+        watchlists={}
+        for application_id, model_name in cursor.execute("select application_id,model_name from "+ApplicationDatabaseConnector.TABLE_MODELS+" where to_check='Y'"):
+            watchlists.setdefault(application_id, []).append(model_name)
+        return watchlists
+
+    # the applications with settings of their own
+    def get_application_ids(self):
+        return sorted(self._default_values)
+
+    def add_model(self,model_name,application_id=None):
+        self.add_models([model_name],application_id)
+
+    # in a single transaction, each statement runs once for all the names
+    def add_models(self,model_names,application_id=None):
+        if application_id is None:
+            application_id = self.application_id
+        self._execute_all([
+                ("update "+ApplicationDatabaseConnector.TABLE_MODELS+" set to_check='Y' where application_id=? and model_name=?",[(application_id,model_name) for model_name in model_names]),
+                ("insert into "+ApplicationDatabaseConnector.TABLE_MODELS+" (application_id,model_name,to_check) select ?,?,'Y' where not exists (select 1 from "+ApplicationDatabaseConnector.TABLE_MODELS+" where application_id=? and model_name=?)",[(application_id,model_name,application_id,model_name) for model_name in model_names])])
+
+    def remove_model(self,model_name,application_id=None):
+        if application_id is None:
+            application_id = self.application_id
+        self._execute_all([
+                ("update "+ApplicationDatabaseConnector.TABLE_MODELS+" set to_check='N' where application_id=? and model_name=?",[(application_id,model_name)])])
+
+    # (statement, rows) pairs, queued to the writer when there is one, otherwise committed right away
+    def _execute_all(self,statements):
+        if self.writer is not None:
+            for statement, rows in statements:
+                self.writer.executemany(statement, rows)
+            return
+        try:
+            cursor = self.connection.cursor()
+            for statement, rows in statements:
+                cursor.executemany(statement, rows)
+            self.connection.commit()
+        except Exception as exc:
+            self.connection.rollback()
+            raise exc
+
+    def get_server_scores(self):
         cursor = self.connection.cursor()
-        models=[]
-        for model in cursor.execute("select model_name from "+ApplicationDatabaseConnector.TABLE_MODELS+" where to_check='Y'"):
-            models.append(model[0])
-        return models
+        scores=[]
+        for row in cursor.execute("select server,connect_time,login_rtt,reply_latency,failures,backoff_until from "+ApplicationDatabaseConnector.TABLE_SERVER_SCORES):
+            scores.append(ServerScore(*row))
+        return scores
 
-    def add_model(self,model_name):
+    def save_server_scores(self,scores):
         try:
             cursor = self.connection.cursor()
-            cursor.execute("select to_check from "+ApplicationDatabaseConnector.TABLE_MODELS+" where model_name=?",(model_name,))
-            row = cursor.fetchone()
-            if row is None:
-                cursor.execute("insert into "+ApplicationDatabaseConnector.TABLE_MODELS+" (model_name,to_check) values (?,'Y')",(model_name,))
-            else:
-                to_check = row[0]
-                if to_check == "N":
-                    cursor.execute("update "+ApplicationDatabaseConnector.TABLE_MODELS+" set to_check='Y' where model_name=?",(model_name,))
+            cursor.executemany("insert or replace into "+ApplicationDatabaseConnector.TABLE_SERVER_SCORES+" (server,connect_time,login_rtt,reply_latency,failures,backoff_until) values (?,?,?,?,?,?)",
+                    [(score.server,score.connect_time,score.login_rtt,score.reply_latency,score.failures,score.backoff_until) for score in scores])
             self.connection.commit()
         except Exception as exc:
-           self.connection.rollback()
-           raise exc
+            self.connection.rollback()
+            raise exc
 
-    def remove_model(self,model_name):
+    def get_model_states(self):
+        cursor = self.connection.cursor()
+        states={}
+        for row in cursor.execute("select model_name,status,is_online,last_seen,last_queried,not_existing from "+ApplicationDatabaseConnector.TABLE_MODEL_STATES):
+            states[row[0]] = (row[1], self._convert_str_to_boolean(row[2]), row[3], row[4], self._convert_str_to_boolean(row[5]))
+        return states
+
+    def save_model_states(self,models):
         try:
             cursor = self.connection.cursor()
-            cursor.execute("select to_check from "+ApplicationDatabaseConnector.TABLE_MODELS+" where model_name=? and to_check='Y'",(model_name,))
-            row = cursor.fetchone()
-            if row is not None:
-                cursor.execute("update "+ApplicationDatabaseConnector.TABLE_MODELS+" set to_check='N' where model_name=?",(model_name,))
+            cursor.execute("delete from "+ApplicationDatabaseConnector.TABLE_MODEL_STATES)
+            cursor.executemany("insert into "+ApplicationDatabaseConnector.TABLE_MODEL_STATES+" (model_name,status,is_online,last_seen,last_queried,not_existing) values (?,?,?,?,?,?)",
+                    [(model.name,model.status,"Y" if model.isOnline else "N",model.lastSeen,model.lastQueried,"Y" if model.notExisting else "N") for model in models if model.lastQueried is not None])
             self.connection.commit()
         except Exception as exc:
-           self.connection.rollback()
-           raise exc
+            self.connection.rollback()
+            raise exc
+
+    def get_status_history(self,model_name,since=0,until=None):
+        cursor = self.connection.cursor()
+        if until is None:
+            until = time.time()
+        return cursor.execute("select status,event_time from "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+" where model_name=? and event_time>=? and event_time<? order by event_time",(model_name,since,until)).fetchall()
 
-    def retrieve_default_value(self,name):
+    # (model name, event time) of all the status changes since the given time, oldest first
+    def get_status_changes(self,since):
         cursor = self.connection.cursor()
-        cursor.execute("select value,conversion_function from "+ApplicationDatabaseConnector.TABLE_DEFAULTS+" where application_id=? and name=?",(self.application_id,name))
+        return cursor.execute("select model_name,event_time from "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+" where event_time>=? order by event_time",(since,)).fetchall()
+
+    # number of seconds the model was online between since and until
+    def get_uptime(self,model_name,since,until=None):
+        cursor = self.connection.cursor()
+        if until is None:
+            until = time.time()
+        # the status at the start of the period is the last one recorded before it
+        cursor.execute("select status from "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+" where model_name=? and event_time<? order by event_time desc limit 1",(model_name,since))
         row = cursor.fetchone()
-        if row is None:
-            raise ValueError("Default value not found.")
-        value=row[0]
-        conversion_function=row[1]
+        online = row is not None and row[0] == MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE
+        uptime = 0.0
+        start = since
+        for status, event_time in self.get_status_history(model_name,since,until):
+            if online:
+                uptime += event_time-start
+            online = status == MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE
+            start = event_time
+        if online:
+            uptime += until-start
+        return uptime
+
+    # all the settings of all the applications are read at once and served from memory afterwards
+    def _load_default_values(self):
+        self._default_values = {}
+        self._conversion_functions = {}
+        self._conversion_function_names = {}
+        cursor = self.connection.cursor()
+        for application_id, name, value, conversion_function in cursor.execute("select application_id,name,value,conversion_function from "+ApplicationDatabaseConnector.TABLE_DEFAULTS):
+            if name not in self._conversion_functions:
+                self._conversion_functions[name] = self._conversion_function(name, conversion_function)
+                self._conversion_function_names[name] = conversion_function
+            self._default_values.setdefault(application_id, {})[name] = self._conversion_functions[name](value)
+
+    def _conversion_function(self,name,conversion_function):
         if conversion_function == "":
-            return value
-        else:
-            try:
-                fct = getattr(self,"_convert_"+conversion_function)
-            except Exception:
-                LOGGER.printline("Unknown conversion function when retrieving default value of"+name,log_level=Logger.LOG_LEVELS.WARN)
-                return value
+            return lambda value: value
+        try:
+            return getattr(self,"_convert_"+conversion_function)
+        except Exception:
+            LOGGER.printline("Unknown conversion function when retrieving default value of"+name,log_level=Logger.LOG_LEVELS.WARN)
+            return lambda value: value
 
-            return fct(value)
+    # the value of another application falls back on the one of this application when it has none
+    def retrieve_default_value(self,name,application_id=None):
+        if application_id is not None and name in self._default_values.get(application_id, {}):
+            return self._default_values[application_id][name]
+        try:
+            return self._default_values[self.application_id][name]
+        except KeyError:
+            raise ValueError("Default value not found.")
 
     def _convert_str_to_double(self,string):
         return float(string)
+    def _convert_str_to_int(self,string):
+        return int(string)
     def _convert_str_to_boolean(self,string):
         if string == "Y":
             return True
         return False
 
-    def update_default_value(self,name,value):
+    def update_default_value(self,name,value,application_id=None):
+        if application_id is None:
+            application_id = self.application_id
+        if name not in self._conversion_functions:
+            LOGGER.printline("Unknown setting "+name,log_level=Logger.LOG_LEVELS.WARN)
+            return
+        self._default_values.setdefault(application_id, {})[name] = self._conversion_functions[name](str(value))
+        # the other applications only get a row of their own once they change a setting
+        self._execute_all([
+                ("insert or replace into "+ApplicationDatabaseConnector.TABLE_DEFAULTS+" (application_id,name,value,conversion_function) values (?,?,?,?)",[(application_id,name,str(value),self._conversion_function_names[name])])])
+
+# owns the connection all the writes of the application go through, from its own thread, so receiving
+# messages and the command line never wait on the database. The status changes of a sweep are committed
+# when flush is called, settings and watchlist updates within MUTATION_DELAY, both in batched transactions
+class DatabaseWriter(threading.Thread):
+    MAX_BATCH=10000
+    MUTATION_DELAY=0.5
+    INSERT_STATUS="insert into "+ApplicationDatabaseConnector.TABLE_STATUS_EVENTS+" (model_name,status,event_time) values (?,?,?)"
+    _FLUSH=object()
+    _STOP=object()
+
+    def __init__(self, db_name):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db_name = db_name
+        self._queue = Queue()
+
+    def record(self, model_name, status, event_time):
+        self._queue.put((DatabaseWriter.INSERT_STATUS, [(model_name, status, event_time)], False))
+
+    def execute(self, statement, parameters=()):
+        self._queue.put((statement, [parameters], True))
+
+    # all the rows are written in the same transaction
+    def executemany(self, statement, rows):
+        self._queue.put((statement, rows, True))
+
+    def flush(self):
+        self._queue.put(DatabaseWriter._FLUSH)
+
+    def stop(self, timeout=5.0):
+        self._queue.put(DatabaseWriter._STOP)
+        if self.isAlive():
+            self.join(timeout)
+
+    def run(self):
+        db_connector = ApplicationDatabaseConnector(self.db_name)
+        connection = db_connector.connection
+        connection.execute("pragma journal_mode=wal")
+        connection.execute("pragma synchronous=normal")
+        batch = []
+        deadline = None
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("update "+ApplicationDatabaseConnector.TABLE_DEFAULTS+" set value=? where application_id=? and name=?",(str(value),self.application_id,name))
-            self.connection.commit()
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline-time.time()) if deadline is not None else None)
+                except Empty:
+                    item = DatabaseWriter._FLUSH
+                if item is not DatabaseWriter._FLUSH and item is not DatabaseWriter._STOP:
+                    batch.append(item[:2])
+                    if item[2] and deadline is None:
+                        deadline = time.time()+DatabaseWriter.MUTATION_DELAY
+                    if len(batch) < DatabaseWriter.MAX_BATCH:
+                        continue
+                self._write(connection, batch)
+                batch = []
+                deadline = None
+                if item is DatabaseWriter._STOP:
+                    break
+        finally:
+            db_connector.close()
+
+    def _write(self, connection, batch):
+        if not batch:
+            return
+        start = time.time()
+        try:
+            # consecutive rows of the same statement are inserted at once, sqlite prepares it once
+            count = 0
+            for statement, items in itertools.groupby(batch, key=lambda item: item[0]):
+                rows = [row for statement, item_rows in items for row in item_rows]
+                connection.executemany(statement, rows)
+                count += len(rows)
+            connection.commit()
+            METRICS.observe("db_write_seconds", time.time()-start)
+            METRICS.inc("db_rows_written", count)
         except Exception as exc:
-            self.connection.rollback()
-            raise exc
+            connection.rollback()
+            LOGGER.printline("Unable to write to the database: "+str(exc), log_level=Logger.LOG_LEVELS.ERROR)
 
-if __name__ == '__main__':
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
 
-    try:
-        db_connector = ApplicationDatabaseConnector(APPLICATION_DATABASE)
-        desktop_notifications=db_connector.retrieve_default_value("DESKTOP_NOTIFICATIONS_ACTIVATED")
-    finally:
-        if db_connector:
-            db_connector.close()
-    if desktop_notifications is not None:
-        LOGGER = Logger(desktop_notifications_activated=desktop_notifications)
-    else:
-        LOGGER = Logger()
+if __name__ == '__main__':
+    launched = time.time()
+    parser = ArgumentParser(description="Checks which MFC models are online")
+    parser.add_argument("--daemon", action="store_true", help="Run without command line, the commands are taken from the control socket")
+    parser.add_argument("--socket", default=path.splitext(APPLICATION_DATABASE)[0]+".sock", help="Control socket of the daemon")
+    parser.add_argument("--control", action="store_true", help="Send the commands read from the standard input to the running daemon and show their output")
+    parser.add_argument("--log-file", default=None, help="Write the log as json lines to this file instead of the console, only the answers to the commands are still shown")
+    parser.add_argument("--log-max-bytes", type=int, default=LogWriter.MAX_BYTES, help="Size at which the log file is rotated")
+    parser.add_argument("--log-backups", type=int, default=LogWriter.BACKUP_COUNT, help="Number of rotated log files kept")
+    arguments = parser.parse_args()
+
+    if arguments.control:
+        ControlSocket.send(arguments.socket, sys.stdin, stdout)
+        exit(0)
 
-    mainApp = MainApplication()
-    userCommandProcessor = MFCcheckerUserCommandProcessor(mainApp)
+    # whether the changes are sent to the desktop is a setting of each tenant
+    LOGGER = Logger()
+    log_writer = LogWriter(LOGGER, arguments.log_file, arguments.log_max_bytes, arguments.log_backups)
+    LOGGER.writer = log_writer
+    log_writer.start()
+    mainApp = MainApplication(launched)
+    # taken before the application starts, it is not left running without its control socket
+    control = None
+    if arguments.daemon:
+        try:
+            control = ControlSocket(arguments.socket, mainApp)
+        except (socket.error, ValueError) as exc:
+            LOGGER.printline("Unable to take commands on "+arguments.socket+": "+str(exc),log_level=Logger.LOG_LEVELS.FATAL)
+            log_writer.stop()
+            exit(1)
+    # the database is only opened by the application, its settings are already loaded
+    notifier = DesktopNotifier(window=mainApp.db_connector.retrieve_default_value("DESKTOP_NOTIFICATIONS_WINDOW"))
+    LOGGER.notifier = notifier
+    notifier.start()
 
     try:
         mainApp.start()
 
+        if control is not None:
+            signal.signal(signal.SIGTERM, _terminate)
+            LOGGER.printline("Taking commands on "+arguments.socket,log_level=Logger.LOG_LEVELS.INFO)
+            try:
+                control.serve()
+            finally:
+                control.close()
+            # the application stopped by itself, shut down the rest as well
+            raise KeyboardInterrupt
+
+        userCommandProcessor = MFCcheckerUserCommandProcessor(mainApp)
         time.sleep(2)
         LOGGER.printline("Initializing command line...",log_level=Logger.LOG_LEVELS.INFO)
         time.sleep(2)
@@ -684,5 +3042,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         LOGGER.printline("Exiting...",log_level=Logger.LOG_LEVELS.INFO)
         mainApp.stopApplication()
+        notifier.stop()
+        log_writer.stop()
         exit(0)
 
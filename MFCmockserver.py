@@ -0,0 +1,148 @@
+import json
+import itertools
+import threading
+import random
+from urllib import quote
+from argparse import ArgumentParser
+from wsgiref.simple_server import make_server
+
+from ws4py.websocket import WebSocket
+from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+import MFCchecker
+from MFCchecker import Logger, MFCProtocol, Scheduler
+
+# local stand-in for the fcserver, answers the login and the model queries (type 10) the way
+# MFCClient expects them. Models are named model_0 ... model_<count-1>, other names do not exist.
+# With push, status changes are also sent to all sessions (type 20), half of them without the name
+class MockFcServer:
+
+    STATUSES=[
+            MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE,
+            MFCProtocol.STATUS_CODES.FCVIDEO_TX_AWAY,
+            MFCProtocol.STATUS_CODES.FCVIDEO_TX_PVT,
+            MFCProtocol.STATUS_CODES.FCVIDEO_RX_IDLE,
+            MFCProtocol.STATUS_CODES.FCVIDEO_UNKNOWN]
+    UID_OFFSET=100000000
+
+    def __init__(self, host="127.0.0.1", port=8080, model_count=1000, latency=0.0, churn=0.0, online_ratio=0.2, seed=None, push=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.churn = churn
+        self.push = push
+        self.sessions = set()
+        self._random = random.Random(seed)
+        self._session_ids = itertools.count(1000)
+        self._statuses = {}
+        self._uids = {}
+        for i in xrange(model_count):
+            model_name = "model_"+str(i)
+            self._statuses[model_name] = MFCProtocol.STATUS_CODES.FCVIDEO_TX_IDLE if self._random.random() < online_ratio else MFCProtocol.STATUS_CODES.FCVIDEO_UNKNOWN
+            self._uids[model_name] = MockFcServer.UID_OFFSET+i
+        self._scheduler = Scheduler()
+        self._server = None
+
+    def serve_forever(self):
+        server = self
+        class Handler(MockFcServerSession):
+            fcserver = server
+        self._server = make_server(self.host, self.port, server_class=WSGIServer, handler_class=WebSocketWSGIRequestHandler,
+                                   app=WebSocketWSGIApplication(handler_cls=Handler))
+        self._server.initialize_websockets_manager()
+        if self.push > 0:
+            self._scheduler.schedule(1.0/self.push, self._pushChange)
+        if self.latency > 0 or self.push > 0:
+            replies = threading.Thread(target=self._scheduler.run, name="MockFcServerReplies")
+            replies.daemon = True
+            replies.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._scheduler.stop()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, session, request):
+        fields = request.split(" ", 5)
+        if fields[0] == "1":
+            session.session_id = str(next(self._session_ids))
+            self.reply(session, "1 0 "+session.session_id+" 0 0 ")
+        elif fields[0] == "10" and len(fields) == 6:
+            model_name = fields[5]
+            status = self._status(model_name)
+            if status is None:
+                self.reply(session, "10 0 "+session.session_id+" "+fields[3]+" 1 "+quote(model_name))
+            else:
+                self.reply(session, "10 0 "+session.session_id+" "+fields[3]+" 0 "+quote(json.dumps(
+                    {"lv": 4, "nm": model_name, "sid": 0, "uid": self._uids[model_name], "vs": status})))
+
+    def reply(self, session, body):
+        if self.latency > 0:
+            self._scheduler.schedule(self.latency, self._send, session, body)
+        else:
+            self._send(session, body)
+
+    def _send(self, session, body):
+        if session.terminated:
+            return
+        try:
+            session.send(("%04d" % len(body))[-4:]+body)
+        except Exception:
+            pass
+
+    def _pushChange(self):
+        self._scheduler.schedule(1.0/self.push, self._pushChange)
+        model_name = self._random.choice(self._statuses.keys())
+        status = self._random.choice(MockFcServer.STATUSES)
+        self._statuses[model_name] = status
+        data = {"lv": 4, "sid": 0, "uid": self._uids[model_name], "vs": status}
+        if self._random.random() < 0.5:
+            data["nm"] = model_name
+        for session in list(self.sessions):
+            self._send(session, "20 0 "+session.session_id+" 0 0 "+quote(json.dumps(data)))
+
+    def _status(self, model_name):
+        status = self._statuses.get(model_name)
+        if status is not None and self.churn > 0 and self._random.random() < self.churn:
+            status = self._random.choice(MockFcServer.STATUSES)
+            self._statuses[model_name] = status
+        return status
+
+class MockFcServerSession(WebSocket):
+    fcserver = None
+    session_id = "0"
+
+    def opened(self):
+        self.fcserver.sessions.add(self)
+
+    def closed(self, code, reason=None):
+        self.fcserver.sessions.discard(self)
+
+    def received_message(self, m):
+        for request in str(m.data).split("\n\0"):
+            if request:
+                self.fcserver.handle(self, request)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Local stand-in for the fcserver, for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--models", type=int, default=1000, help="Number of existing models, named model_0 to model_<models-1>")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay before each reply (in seconds)")
+    parser.add_argument("--churn", type=float, default=0.0, help="Probability that the status of a model changes when it is queried")
+    parser.add_argument("--online", type=float, default=0.2, help="Ratio of models that are online at start")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--push", type=float, default=0.0, help="Number of status changes per second pushed to all sessions")
+    arguments = parser.parse_args()
+
+    MFCchecker.LOGGER = Logger(log_level=Logger.LOG_LEVELS.ERROR, desktop_notifications_activated=False)
+    server = MockFcServer(arguments.host, arguments.port, arguments.models, arguments.latency, arguments.churn, arguments.online, arguments.seed, arguments.push)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,109 @@
+import sys
+import time
+import cProfile
+import pstats
+from argparse import ArgumentParser
+
+import MFCchecker
+from MFCchecker import Logger, MFCProtocol, MFCModelRegistry, FrameRecorder
+
+class RecordedMessage:
+    def __init__(self, data):
+        self.data = data
+
+# a session without socket: the received frames come from a recording, the sent ones are only counted
+class ReplaySession(MFCProtocol):
+    terminated = False
+
+    def __init__(self, models):
+        self._initProtocol()
+        self.models = models
+        self.sent = 0
+
+    def send(self, payload, binary=False):
+        self.sent += 1
+
+    # the queries are the ones of the recording, the login does not send new ones
+    def _check(self):
+        pass
+
+    # a recorded query, its reply is matched by the recorded request id
+    def replaySent(self, frame):
+        fields = frame.split(" ", 5)
+        if len(fields) != 6 or fields[0] != "10":
+            return
+        model = self.models.get(fields[5])
+        if model is None:
+            return
+        now = time.time()
+        model.lastQueried = now
+        if model.pendingSince is None:
+            model.pendingSince = now
+        with self._pending_lock:
+            self._pending[fields[3]] = (model, now, 0)
+
+# the models watched when the recording started or queried later, plus the given ones
+def watched_models(frames, model_names=()):
+    models = MFCModelRegistry(model_names)
+    for frame_time, direction, frame in frames:
+        if direction == FrameRecorder.WATCHED:
+            for entry in frame.split(" "):
+                model_name, separator, uid = entry.partition(":")
+                if model_name:
+                    models.add(model_name)
+                    if uid:
+                        models.setUid(models.get(model_name), int(uid))
+        elif direction == FrameRecorder.SENT:
+            fields = frame.split(" ", 5)
+            if len(fields) == 6 and fields[0] == "10":
+                models.add(fields[5])
+    return models
+
+# feeds the received frames to the session, at the recorded speed times speed or as fast as possible (speed 0).
+# The sent queries are registered in between, in their recorded order
+def replay(session, frames, speed=0.0):
+    count = 0
+    start = time.time()
+    first_time = None
+    for frame_time, direction, frame in frames:
+        if direction == FrameRecorder.SENT:
+            session.replaySent(frame)
+            continue
+        if direction != FrameRecorder.RECEIVED:
+            continue
+        if speed > 0:
+            if first_time is None:
+                first_time = frame_time
+            delay = start+(frame_time-first_time)/speed-time.time()
+            if delay > 0:
+                time.sleep(delay)
+        session.received_message(RecordedMessage(frame))
+        count += 1
+    return count, time.time()-start
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Replays a recording of the record command through the frame handling of the MFC online checker")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=0.0, help="Replay speed relative to the recording, 0 for as fast as possible")
+    parser.add_argument("--models", default="", help="Comma separated names to watch besides the models of the recording")
+    parser.add_argument("--loglevel", default="ERROR", help="Log level, INFO shows the transitions")
+    parser.add_argument("--profile", action="store_true", help="Show the functions that took the most time")
+    arguments = parser.parse_args()
+
+    MFCchecker.LOGGER = Logger(log_level=getattr(Logger.LOG_LEVELS, arguments.loglevel.upper()), desktop_notifications_activated=False)
+    frames = list(FrameRecorder.read(arguments.recording))
+    models = watched_models(frames, [name for name in arguments.models.split(",") if name])
+    session = ReplaySession(models)
+    session.desktop_notify_enabled = False
+
+    profiler = cProfile.Profile() if arguments.profile else None
+    if profiler is not None:
+        profiler.enable()
+    count, duration = replay(session, frames, arguments.speed)
+    if profiler is not None:
+        profiler.disable()
+
+    print("%d frames replayed in %.4f s (%.0f /s), %d models watched, %d online" % (
+        count, duration, count/duration if duration > 0 else 0, len(models), len(models.online())))
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(25)